@@ -0,0 +1,10 @@
+"""`python -m backend` from the repo root: run the production server (see server.py)."""
+import os
+import sys
+
+# The backend modules import each other top-level (`from models import ...`)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server import main  # noqa: E402
+
+main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Benchmark request decode and response encode cost at 10, 100 and 500 history messages.
+Run: python bench_codec.py [--iterations 2000]
+
+Compares the old handler path (request.json() -> ChatRequest(**data) -> history dict
+copies; jsonable_encoder + json.dumps) with codec.py (model_validate_json; orjson /
+model_dump_json), and reports gzip/brotli sizes of the encoded response.
+"""
+import argparse
+import json
+import time
+
+from fastapi.encoders import jsonable_encoder
+
+import codec
+from models import ChatRequest, ChatResponse
+
+
+def make_body(n):
+    history = [
+        {"role": "user" if i % 2 == 0 else "assistant",
+         "content": f"Message {i}: I worked at Acme Corp as a backend engineer building APIs in Python and Go."}
+        for i in range(n)
+    ]
+    return json.dumps({"conversationHistory": history, "userMessage": "create resume", "role": "general"}).encode()
+
+
+def make_response(n):
+    resume = {
+        "profile": {"name": "John Doe", "email": "john@example.com", "phone": "5551234567", "location": "Boston, MA", "summary": "Backend engineer. " * 5},
+        "workExperience": [{"company": f"Company {i}", "position": "Engineer", "description": "Built APIs. " * 10} for i in range(max(1, n // 10))],
+        "educations": [{"degree": "BS Computer Science", "school": "Northeastern", "year": "2018"}],
+        "skills": {"technical": ["Python", "Go", "SQL", "Docker", "AWS"], "soft": ["Communication"]},
+    }
+    return ChatResponse(assistantMessage="Your resume is ready!", resumeData=resume)
+
+
+def old_decode(body):
+    data = json.loads(body)
+    req = ChatRequest(**data)
+    history_dicts = [{"role": m.role, "content": m.content} for m in req.conversationHistory]
+    return req, history_dicts
+
+
+def new_decode(body):
+    return codec.decode_model(ChatRequest, body)
+
+
+def old_encode(resp):
+    return json.dumps(jsonable_encoder(resp), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode()
+
+
+def new_encode(resp):
+    return codec.dumps(resp)
+
+
+def timeit(fn, arg, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(arg)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"orjson={codec.ORJSON_AVAILABLE} brotli={codec.BROTLI_AVAILABLE}\n")
+    print(f"{'history':>8}{'decode old us':>15}{'decode new us':>15}{'encode old us':>15}{'encode new us':>15}{'resp bytes':>12}{'gzip':>8}{'br':>8}")
+    for n in (10, 100, 500):
+        body, resp = make_body(n), make_response(n)
+        encoded = new_encode(resp)
+        br = len(codec.compress(encoded, "br")) if codec.BROTLI_AVAILABLE else "-"
+        print(
+            f"{n:>8}"
+            f"{timeit(old_decode, body, args.iterations):>15.1f}"
+            f"{timeit(new_decode, body, args.iterations):>15.1f}"
+            f"{timeit(old_encode, resp, args.iterations):>15.1f}"
+            f"{timeit(new_encode, resp, args.iterations):>15.1f}"
+            f"{len(encoded):>12}"
+            f"{len(codec.compress(encoded, 'gzip')):>8}"
+            f"{br:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Memory per held session at 10k and 100k concurrent sessions.
+Run: python bench_compact_store.py [--sessions 10000 100000] [--messages 12]
+
+Compares, per session of --messages messages:
+  messages+dicts  List[models.Message] plus the history_dicts copy (old /api/chat path)
+  dicts           list of {"role", "content"} dicts (old /ws/chat ChatSession)
+  compact         compact_store.CompactConversation
+  compact+zlib    the same after compress() (sessions idle past COMPACT_IDLE_SECONDS)
+
+Each session is decoded from JSON inside the measured region, as it would arrive
+from a request, so sizes (from tracemalloc) include the message text itself.
+"""
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+
+from compact_store import CompactConversation
+from models import Message
+
+PHRASES = [
+    "I worked at Acme Corp as a backend engineer",
+    "building REST APIs in Python and Go",
+    "led a team of four developers",
+    "reduced p95 latency by 40%",
+    "Bachelor of Science in Computer Science, 2018",
+    "skills: Docker, Kubernetes, PostgreSQL, AWS",
+    "What was your role at that company?",
+    "Great! Could you share your email and phone number?",
+]
+
+
+def make_conversation(session: int, n: int, rng: random.Random):
+    messages = []
+    for i in range(n):
+        text = " ".join(rng.choice(PHRASES) for _ in range(rng.randint(1, 4)))
+        # Unique per session so strings aren't shared between sessions
+        messages.append({"role": "user" if i % 2 == 0 else "assistant", "content": f"{text} (#{session}.{i})"})
+    return messages
+
+
+def build_messages_and_dicts(raw):
+    history = [Message(**m) for m in json.loads(raw)]
+    return history, [{"role": m.role, "content": m.content} for m in history]
+
+
+def build_dicts(raw):
+    return json.loads(raw)
+
+
+def build_compact(raw):
+    return CompactConversation(json.loads(raw))
+
+
+def build_compact_zlib(raw):
+    conversation = CompactConversation(json.loads(raw))
+    conversation.compress()
+    return conversation
+
+
+LAYOUTS = [
+    ("messages+dicts", build_messages_and_dicts),
+    ("dicts", build_dicts),
+    ("compact", build_compact),
+    ("compact+zlib", build_compact_zlib),
+]
+
+
+def measure(build, sessions, messages):
+    rng = random.Random(42)
+    conversations = [make_conversation(s, messages, rng) for s in range(sessions)]
+    text_bytes = sum(len(m["content"].encode()) for c in conversations for m in c)
+    raws = [json.dumps(c) for c in conversations]
+    del conversations
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    held = [build(raw) for raw in raws]
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del held
+    return size, text_bytes, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--messages", type=int, default=12)
+    args = parser.parse_args()
+
+    for sessions in args.sessions:
+        print(f"\n{sessions:,} sessions x {args.messages} messages")
+        print(f"{'layout':<16}{'total MB':>10}{'bytes/session':>16}{'vs text':>9}{'build s':>9}")
+        for name, build in LAYOUTS:
+            size, text_bytes, elapsed = measure(build, sessions, args.messages)
+            print(f"{name:<16}{size / 1e6:>10.1f}{size / sessions:>16,.0f}{size / text_bytes:>8.2f}x{elapsed:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
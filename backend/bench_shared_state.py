@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Benchmark cache-hit latency of the shared state backends against the in-process store.
+Run: python bench_shared_state.py [--iterations 20000] [--redis redis://localhost:6379/0]
+
+Also checks that counters really are shared by running incr() from several
+processes against the SQLite store.
+"""
+import argparse
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from shared_state import MemoryStore, SQLiteStore, create_store
+
+VALUE = {"assistantMessage": "Great, John! What's your professional email?", "resumeData": {"nextQuestion": "Email?"}}
+
+
+def bench_hits(store, iterations):
+    keys = [f"cache:bench:{i}" for i in range(256)]
+    for key in keys:
+        store.set(key, VALUE, ttl=600)
+    samples = []
+    for i in range(iterations):
+        key = keys[i % len(keys)]
+        start = time.perf_counter_ns()
+        store.get(key)
+        samples.append(time.perf_counter_ns() - start)
+    samples.sort()
+    return {
+        "p50_us": samples[len(samples) // 2] / 1000,
+        "p99_us": samples[int(len(samples) * 0.99)] / 1000,
+        "mean_us": statistics.fmean(samples) / 1000,
+    }
+
+
+def _incr_worker(path, count):
+    store = SQLiteStore(path)
+    for _ in range(count):
+        store.incr("rate:bench", ttl=600)
+
+
+def check_cross_process(path, workers=4, count=500):
+    procs = [multiprocessing.Process(target=_incr_worker, args=(path, count)) for _ in range(workers)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    return SQLiteStore(path).get("rate:bench"), workers * count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--redis", default=os.getenv("BENCH_REDIS_URL"))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stores = [("memory (in-process)", MemoryStore()), ("sqlite WAL+mmap", SQLiteStore(os.path.join(tmp, "hits.db")))]
+        if args.redis:
+            stores.append(("redis", create_store(args.redis)))
+
+        print(f"{'backend':<22}{'p50 us':>10}{'p99 us':>10}{'mean us':>10}")
+        for name, store in stores:
+            r = bench_hits(store, args.iterations)
+            print(f"{name:<22}{r['p50_us']:>10.2f}{r['p99_us']:>10.2f}{r['mean_us']:>10.2f}")
+
+        got, expected = check_cross_process(os.path.join(tmp, "counters.db"))
+        print(f"\ncross-process incr (sqlite): {got}/{expected} {'✅' if got == expected else '❌'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Request/response codec helpers.
+
+- decode_model(): bytes -> Pydantic model in one pass (no json.loads + re-validate)
+- FastJSONResponse: serializes with orjson when installed, compact stdlib JSON otherwise
+- CompressionMiddleware: brotli (if installed) or gzip for responses above a size threshold
+"""
+import gzip
+import json
+import os
+from typing import Any, Type, TypeVar
+
+from pydantic import BaseModel
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "image/svg+xml")
+
+M = TypeVar("M", bound=BaseModel)
+
+
+def decode_model(model_cls: Type[M], body: bytes) -> M:
+    """Parse and validate a JSON body straight into `model_cls`."""
+    if hasattr(model_cls, "model_validate_json"):
+        return model_cls.model_validate_json(body)
+    return model_cls.parse_raw(body)  # pydantic v1
+
+
+def dumps(content: Any) -> bytes:
+    """Serialize to compact UTF-8 JSON bytes."""
+    if isinstance(content, BaseModel):
+        if hasattr(content, "model_dump_json"):
+            return content.model_dump_json().encode("utf-8")
+        return content.json().encode("utf-8")  # pydantic v1
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse that also accepts Pydantic models and skips the jsonable_encoder walk."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def choose_encoding(accept_encoding: str):
+    accepted = {token.split(";")[0].strip().lower() for token in accept_encoding.split(",")}
+    if BROTLI_AVAILABLE and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing single-chunk responses of at least `minimum_size` bytes.
+
+    Streaming responses (more_body=True on the first chunk) and responses that
+    already carry a Content-Encoding pass through untouched, so SSE/text streams
+    are never buffered.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESS_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+
+        async def wrapped_send(message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            headers = MutableHeaders(raw=start_message["headers"])
+            body = message.get("body", b"")
+            eligible = (
+                not message.get("more_body", False)
+                and len(body) >= self.minimum_size
+                and "content-encoding" not in headers
+                and headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+            )
+            if not eligible:
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            body = compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            await send(start_message)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, wrapped_send)
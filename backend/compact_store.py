@@ -0,0 +1,166 @@
+"""
+Compact in-memory conversation storage.
+
+A held conversation as a list of {"role", "content"} dicts (or models.Message
+objects) costs a dict/object, a role string reference and a str object per
+message - several hundred bytes of overhead before the text itself.
+CompactConversation instead keeps:
+
+- roles as one byte each in an array('B'), using interned role codes
+- all message text UTF-8 encoded back to back in one bytearray
+- the end offset of each message in an array('I')
+
+CompactConversationStore holds conversations by key and zlib-compresses the
+ones not touched for COMPACT_IDLE_SECONDS; they are expanded again on the
+next access. Measure with `python bench_compact_store.py`.
+"""
+import os
+import time
+import zlib
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
+
+COMPACT_IDLE_SECONDS = float(os.getenv("COMPACT_IDLE_SECONDS", "300"))
+COMPACT_SWEEP_INTERVAL = float(os.getenv("COMPACT_SWEEP_INTERVAL", "30"))
+
+# Interned role names; codes are indexes (one byte)
+_ROLES: List[str] = ["user", "assistant", "system"]
+_ROLE_CODES: Dict[str, int] = {role: code for code, role in enumerate(_ROLES)}
+
+
+def _role_code(role: str) -> int:
+    code = _ROLE_CODES.get(role)
+    if code is None:
+        if len(_ROLES) >= 256:
+            raise ValueError(f"Too many distinct roles to intern: {role!r}")
+        code = len(_ROLES)
+        _ROLES.append(role)
+        _ROLE_CODES[role] = code
+    return code
+
+
+class CompactConversation:
+    """Array-backed message list; compress() packs it into one zlib blob."""
+
+    __slots__ = ("_roles", "_ends", "_text", "_packed", "_count", "last_access")
+
+    def __init__(self, messages=()):
+        self._roles = array("B")
+        self._ends = array("I")
+        self._text = bytearray()
+        self._packed: Optional[bytes] = None
+        self._count = 0
+        self.last_access = time.monotonic()
+        for message in messages:
+            self.append(message.get("role", "user"), message.get("content", ""))
+
+    @property
+    def compressed(self) -> bool:
+        return self._packed is not None
+
+    def _expand(self):
+        raw = zlib.decompress(self._packed)
+        self._ends = array("I")
+        roles_end = self._count
+        ends_end = roles_end + self._count * self._ends.itemsize
+        self._roles = array("B", raw[:roles_end])
+        self._ends.frombytes(raw[roles_end:ends_end])
+        self._text = bytearray(raw[ends_end:])
+        self._packed = None
+
+    def _touch(self):
+        self.last_access = time.monotonic()
+        if self._packed is not None:
+            self._expand()
+
+    def compress(self):
+        if self._packed is not None or not self._count:
+            return
+        self._packed = zlib.compress(self._roles.tobytes() + self._ends.tobytes() + bytes(self._text))
+        self._roles = self._ends = self._text = None
+
+    def append(self, role: str, content: str):
+        self._touch()
+        self._text += content.encode("utf-8")
+        self._roles.append(_role_code(role))
+        self._ends.append(len(self._text))
+        self._count += 1
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        self._touch()
+        start = 0
+        text = self._text
+        for code, end in zip(self._roles, self._ends):
+            yield _ROLES[code], text[start:end].decode("utf-8")
+            start = end
+
+    def messages(self) -> List[Dict[str, str]]:
+        """Materialize as [{"role", "content"}] (what the clients and fact_extractor take)."""
+        return [{"role": role, "content": content} for role, content in self]
+
+    def nbytes(self) -> int:
+        """Payload bytes held (buffers or the compressed blob), excluding fixed object overhead."""
+        if self._packed is not None:
+            return len(self._packed)
+        return len(self._text) + len(self._roles) + len(self._ends) * self._ends.itemsize
+
+
+class CompactConversationStore:
+    """Conversations by key; idle ones are compressed during periodic sweeps."""
+
+    def __init__(self, idle_seconds: float = COMPACT_IDLE_SECONDS, sweep_interval: float = COMPACT_SWEEP_INTERVAL):
+        self.idle_seconds = idle_seconds
+        self.sweep_interval = sweep_interval
+        self._conversations: Dict[str, CompactConversation] = {}
+        self._last_sweep = time.monotonic()
+
+    def maybe_sweep(self):
+        """Compress idle conversations if sweep_interval has passed since the last sweep."""
+        now = time.monotonic()
+        if now - self._last_sweep >= self.sweep_interval:
+            self._last_sweep = now
+            self.compress_idle(now)
+
+    def set(self, key: str, messages=()):
+        self.maybe_sweep()
+        self._conversations[key] = CompactConversation(messages)
+
+    def append(self, key: str, role: str, content: str):
+        self.maybe_sweep()
+        conversation = self._conversations.get(key)
+        if conversation is None:
+            conversation = self._conversations[key] = CompactConversation()
+        conversation.append(role, content)
+
+    def history(self, key: str) -> List[Dict[str, str]]:
+        self.maybe_sweep()
+        conversation = self._conversations.get(key)
+        return conversation.messages() if conversation is not None else []
+
+    def drop(self, key: str):
+        self._conversations.pop(key, None)
+
+    def compress_idle(self, now: Optional[float] = None) -> int:
+        """Compress conversations idle for idle_seconds; returns how many were compressed."""
+        cutoff = (now if now is not None else time.monotonic()) - self.idle_seconds
+        compressed = 0
+        for conversation in self._conversations.values():
+            if not conversation.compressed and conversation.last_access <= cutoff:
+                conversation.compress()
+                compressed += 1
+        return compressed
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+    def stats(self) -> Dict[str, int]:
+        conversations = self._conversations.values()
+        return {
+            "conversations": len(self._conversations),
+            "compressed": sum(1 for c in conversations if c.compressed),
+            "messages": sum(len(c) for c in conversations),
+            "payload_bytes": sum(c.nbytes() for c in conversations),
+        }
@@ -2,8 +2,12 @@ import os
 import logging
 import re
 import json
+from usage import estimate_tokens
+from profiling import stage
+from log_config import setup_logging, log_exception
+from key_pool import KeyPool
 
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 try:
@@ -14,17 +18,14 @@ except ImportError:
     logger.warning("⚠️ google-generativeai not installed")
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
-if GEMINI_API_KEY and GENAI_AVAILABLE:
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        logger.info("✅ Gemini AI configured successfully")
-    except Exception as e:
-        logger.warning(f"⚠️ Failed to configure Gemini: {e}")
-else:
-    if not GEMINI_API_KEY:
-        logger.warning("⚠️ GEMINI_API_KEY not set - AI features will be limited")
-    if not GENAI_AVAILABLE:
-        logger.warning("⚠️ google-generativeai not installed - install with: pip install google-generativeai")
+GEMINI_API_KEYS = os.getenv("GEMINI_API_KEYS", "")
+# Per-key request budget and bench time after a 429 (see key_pool.py)
+GEMINI_KEY_RPM = int(os.getenv("GEMINI_KEY_RPM", "10"))
+GEMINI_KEY_BENCH_SECONDS = float(os.getenv("GEMINI_KEY_BENCH_SECONDS", "30"))
+if not (GEMINI_API_KEY or GEMINI_API_KEYS):
+    logger.warning("⚠️ GEMINI_API_KEY not set - AI features will be limited")
+if not GENAI_AVAILABLE:
+    logger.warning("⚠️ google-generativeai not installed - install with: pip install google-generativeai")
 
 # Role-based System Prompts for Resume Building
 GENERAL_RESUME_PROMPT = """You are a resume-builder AI assistant.
@@ -81,27 +82,138 @@ SYSTEM_PROMPTS = {
     "educator": GENERAL_RESUME_PROMPT,
 }
 
+# Plain chat (/api/chatnormal): short prompt, plain text, small output budget
+PLAIN_CHAT_PROMPT = """You are a friendly career and resume assistant. Answer conversationally and concisely in plain text. Do not output JSON."""
+PLAIN_CHAT_MAX_TOKENS = int(os.getenv("PLAIN_CHAT_MAX_TOKENS", "512"))
+
+GEMINI_MODEL_NAME = 'gemini-2.5-flash'
+
+class _GeminiModels:
+    """
+    Resume and plain-chat models bound to one API key's own client (no global genai.configure).
+
+    google-generativeai has no public per-client API, so this uses its private
+    client._ClientManager and GenerativeModel._client; requirements.txt pins
+    the SDK version this was written against (0.8.6, the final release).
+    """
+
+    def __init__(self, api_key: str, model_name: str):
+        from google.generativeai import client as genai_client
+        manager = genai_client._ClientManager()
+        manager.configure(api_key=api_key)
+        service = manager.make_client("generative")
+        self.model = genai.GenerativeModel(model_name)
+        self.model._client = service
+        self.chat_model = genai.GenerativeModel(model_name, system_instruction=PLAIN_CHAT_PROMPT)
+        self.chat_model._client = service
+
+
 class GeminiClient:
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, usage_ledger=None, api_keys=None, store=None, semantic_cache=None):
+        """
+        Args:
+            api_key: Single Gemini API key (used when api_keys is empty)
+            usage_ledger: Optional usage.UsageLedger for token accounting
+            api_keys: Pool of keys; requests rotate across them by remaining quota
+            store: Optional shared_state store so key quotas are shared across workers
+            semantic_cache: Optional semantic_cache.SemanticCache for near-duplicate short turns
+        """
         self.api_key = api_key
-        self.model = None
+        self.key_pool = None
+        self.model_name = GEMINI_MODEL_NAME
+        self.usage_ledger = usage_ledger
+        self.semantic_cache = semantic_cache
         if not GENAI_AVAILABLE:
             logger.error("❌ google-generativeai not installed")
             return
         
-        if api_key:
-            try:
-                import google.generativeai as genai
-                genai.configure(api_key=api_key)
-                self.model = genai.GenerativeModel('gemini-2.5-flash')
-                logger.info("✅ GeminiClient initialized successfully")
-            except Exception as e:
-                logger.error(f"❌ Failed to initialize GeminiClient: {e}")
+        keys = api_keys or ([api_key] if api_key else [])
+        if keys:
+            self.key_pool = KeyPool(
+                "gemini", keys, lambda key: _GeminiModels(key, self.model_name),
+                rpm_limit=GEMINI_KEY_RPM, bench_seconds=GEMINI_KEY_BENCH_SECONDS, store=store,
+            )
+            if self.available:
+                logger.info(f"✅ GeminiClient initialized successfully ({len(self.key_pool)} key(s))")
         else:
             logger.warning("⚠️ No API key provided to GeminiClient")
 
-    def send_message(self, history, user_message, role="general", facts_context=""):
+    @property
+    def available(self):
+        """True when at least one key has a working client."""
+        return self.key_pool is not None and len(self.key_pool) > 0
+
+    def _build_prompt(self, history, user_message, role="general", facts_context=""):
+        """Build the single-string prompt: system prompt, known facts, history, new message."""
+        # Get system prompt based on role
+        system_prompt = SYSTEM_PROMPTS.get(role, SYSTEM_PROMPTS["general"])
+
+        # Build conversation context with system prompt and facts
+        prompt = system_prompt
+        if facts_context:
+            prompt += f"\n\n---KNOWN FACTS---\n{facts_context}\n"
+        prompt += "\n\n---CONVERSATION HISTORY---\n"
+        for msg in history:
+            prompt += f"{msg.get('role', 'user')}: {msg.get('content', '')}\n"
+        prompt += f"\nuser: {user_message}\n"
+        return prompt
+
+    @staticmethod
+    def parse_json_text(text):
+        """Parse resume JSON from raw model text, falling back to a ```json fenced block."""
+        try:
+            return json.loads(text)
+        except Exception:
+            # Try extracting JSON from markdown code blocks
+            json_match = re.search(r"```json\n?([\s\S]*?)```", text)
+            if json_match:
+                try:
+                    return json.loads(json_match.group(1))
+                except Exception:
+                    pass
+        return None
+
+    def _parse_parts(self, parts):
+        """Return (assistant_message, resume_data) from response content parts."""
+        assistant_message = None
+        resume_data = None
+
+        for part in parts:
+            if hasattr(part, 'text'):
+                assistant_message = part.text
+                resume_data = self.parse_json_text(part.text)
+            elif isinstance(part, dict):
+                resume_data = part
+                assistant_message = json.dumps(part, indent=2)
+            elif isinstance(part, str):
+                assistant_message = part
+                try:
+                    resume_data = json.loads(part)
+                except Exception:
+                    pass
+        return assistant_message, resume_data
+
+    def _record_usage(self, usage_metadata, prompt, output_text, session_id, role, endpoint):
+        """Report token usage to the ledger, estimating when Gemini sent no usage_metadata."""
+        if self.usage_ledger is None:
+            return
+        prompt_tokens = getattr(usage_metadata, "prompt_token_count", None) if usage_metadata else None
+        if prompt_tokens is None:
+            self.usage_ledger.record(
+                session_id=session_id, role=role, model=self.model_name, endpoint=endpoint,
+                prompt_tokens=estimate_tokens(prompt), completion_tokens=estimate_tokens(output_text),
+                estimated=True,
+            )
+            return
+        self.usage_ledger.record(
+            session_id=session_id, role=role, model=self.model_name, endpoint=endpoint,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=getattr(usage_metadata, "candidates_token_count", 0) or 0,
+            cached_tokens=getattr(usage_metadata, "cached_content_token_count", 0) or 0,
+        )
+
+    def send_message(self, history, user_message, role="general", facts_context="", session_id=None, endpoint="chat"):
         """
         Send message to Gemini with role-based system prompt for resume building.
         
@@ -110,29 +222,30 @@ class GeminiClient:
             user_message: Current user message
             role: Role-based prompt ("general", "hr", "educator")
             facts_context: Pre-extracted facts to avoid repetitive questions
+            session_id: Session to charge token usage to (optional)
+            endpoint: Endpoint name for usage accounting
         
         Returns:
             tuple: (assistant_message, resume_data)
             - assistant_message: Plain text response from AI
             - resume_data: Extracted structured JSON with section and fields
         """
-        if not self.model:
+        if not self.available:
             error_msg = "❌ Model not initialized - API key missing or google-generativeai not installed"
             logger.error(error_msg)
             return error_msg, None
         
+        cache_token = None
+        if self.semantic_cache is not None:
+            cached, cache_token = self.semantic_cache.lookup(
+                user_message, history, "gemini", self.model_name, role, facts_context
+            )
+            if cached is not None:
+                return cached
+
         try:
-            # Get system prompt based on role
-            system_prompt = SYSTEM_PROMPTS.get(role, SYSTEM_PROMPTS["general"])
-
-            # Build conversation context with system prompt and facts
-            prompt = system_prompt
-            if facts_context:
-                prompt += f"\n\n---KNOWN FACTS---\n{facts_context}\n"
-            prompt += "\n\n---CONVERSATION HISTORY---\n"
-            for msg in history:
-                prompt += f"{msg.get('role', 'user')}: {msg.get('content', '')}\n"
-            prompt += f"\nuser: {user_message}\n"
+            with stage("prompt_build"):
+                prompt = self._build_prompt(history, user_message, role, facts_context)
 
             logger.info(f"📤 Sending resume builder message to Gemini (role={role})")
             logger.info(f"📝 Prompt length: {len(prompt)} chars")
@@ -140,13 +253,14 @@ class GeminiClient:
             # Use generation_config dict instead of GenerateContentConfig to avoid API version issues
             response = None
             try:
-                response = self.model.generate_content(
-                    prompt,
-                    generation_config={
-                        'max_output_tokens': 2048,
-                        'response_mime_type': 'application/json'
-                    }
-                )
+                with stage("upstream"):
+                    response = self.key_pool.call(lambda models: models.model.generate_content(
+                        prompt,
+                        generation_config={
+                            'max_output_tokens': 2048,
+                            'response_mime_type': 'application/json'
+                        }
+                    ))
             except Exception as api_error:
                 error_msg = f"❌ Gemini API Error: {str(api_error)}"
                 logger.error(error_msg)
@@ -165,41 +279,175 @@ class GeminiClient:
                 return error_msg, None
             
             # Extract text and JSON from response
-            assistant_message = None
-            resume_data = None
-            
-            for part in parts:
-                if hasattr(part, 'text'):
-                    assistant_message = part.text
-                    try:
-                        resume_data = json.loads(part.text)
-                    except Exception:
-                        # Try extracting JSON from markdown code blocks
-                        json_match = re.search(r"```json\n?([\s\S]*?)```", part.text)
-                        if json_match:
-                            try:
-                                resume_data = json.loads(json_match.group(1))
-                            except Exception:
-                                pass
-                elif isinstance(part, dict):
-                    resume_data = part
-                    assistant_message = json.dumps(part, indent=2)
-                elif isinstance(part, str):
-                    assistant_message = part
-                    try:
-                        resume_data = json.loads(part)
-                    except Exception:
-                        pass
-            
+            with stage("parse"):
+                assistant_message, resume_data = self._parse_parts(parts)
+
             if assistant_message is None:
                 assistant_message = ""
             
+            self._record_usage(getattr(response, "usage_metadata", None), prompt, assistant_message, session_id, role, endpoint)
+            
             logger.info(f"✅ Received response: {len(assistant_message)} chars, has_json={resume_data is not None}")
+            if self.semantic_cache is not None and assistant_message:
+                self.semantic_cache.store(cache_token, (assistant_message, resume_data))
             return assistant_message, resume_data
             
         except Exception as e:
             error_msg = f"❌ Error communicating with Gemini: {str(e)}"
+            log_exception(logger, error_msg)
+            return error_msg, None
+
+    def stream_message(self, history, user_message, role="general", facts_context="", session_id=None, endpoint="ws_chat"):
+        """
+        Stream the resume builder response from Gemini as text deltas.
+
+        Same prompt and generation config as send_message, but yields text
+        chunks as they arrive. The caller joins the chunks and parses the
+        full text with parse_json_text() to get resume_data.
+
+        Raises:
+            RuntimeError: if the model is not initialized
+        """
+        if not self.available:
+            raise RuntimeError("Model not initialized - API key missing or google-generativeai not installed")
+
+        prompt = self._build_prompt(history, user_message, role, facts_context)
+        logger.info(f"📤 Streaming resume builder message to Gemini (role={role})")
+
+        # The first chunk is fetched inside generate_content, so a 429 still rotates keys here
+        response = self.key_pool.call(lambda models: models.model.generate_content(
+            prompt,
+            generation_config={
+                'max_output_tokens': 2048,
+                'response_mime_type': 'application/json'
+            },
+            stream=True
+        ))
+        usage_metadata = None
+        output_chars = []
+        for chunk in response:
+            # The last chunk carries the totals for the whole response
+            usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+            try:
+                text = chunk.text
+            except Exception:
+                # Chunks without text parts (e.g. safety/finish metadata)
+                continue
+            if text:
+                output_chars.append(text)
+                yield text
+        self._record_usage(usage_metadata, prompt, "".join(output_chars), session_id, role, endpoint)
+
+    @staticmethod
+    def _to_contents(history, user_message):
+        """Native multi-turn contents: Gemini calls the assistant role 'model'."""
+        contents = [
+            {"role": "model" if msg.get('role') == "assistant" else "user", "parts": [msg.get('content', '')]}
+            for msg in history
+        ]
+        contents.append({"role": "user", "parts": [user_message]})
+        return contents
+
+    @staticmethod
+    def _chat_text(history, user_message):
+        """Flat text of a plain chat request, only used to estimate tokens when usage is missing."""
+        return PLAIN_CHAT_PROMPT + "".join(msg.get('content', '') for msg in history) + user_message
+
+    def _chat_request(self, history, user_message, max_output_tokens, stream):
+        contents = self._to_contents(history, user_message)
+        return self.key_pool.call(lambda models: models.chat_model.generate_content(
+            contents,
+            generation_config={
+                'max_output_tokens': min(max_output_tokens or PLAIN_CHAT_MAX_TOKENS, PLAIN_CHAT_MAX_TOKENS),
+                'response_mime_type': 'text/plain'
+            },
+            stream=stream
+        ))
+
+    def chat(self, history, user_message, max_output_tokens=None, session_id=None):
+        """
+        Plain conversational reply (no resume prompt, no JSON).
+
+        Args:
+            history: Previous messages ({"role": "user"|"assistant", "content": ...})
+            user_message: Current user message
+            max_output_tokens: Requested output cap, clamped to PLAIN_CHAT_MAX_TOKENS
+
+        Returns:
+            str: assistant text (an error message on failure)
+        """
+        if not self.available:
+            error_msg = "❌ Model not initialized - API key missing or google-generativeai not installed"
+            logger.error(error_msg)
+            return error_msg
+
+        try:
+            with stage("upstream"):
+                response = self._chat_request(history, user_message, max_output_tokens, stream=False)
+            try:
+                text = response.text
+            except Exception:
+                # No text parts (blocked or empty candidate)
+                text = ""
+            self._record_usage(
+                getattr(response, "usage_metadata", None), self._chat_text(history, user_message), text,
+                session_id, "plain", "chatnormal"
+            )
+            return text
+        except Exception as e:
+            error_msg = f"❌ Error communicating with Gemini: {str(e)}"
+            log_exception(logger, error_msg)
+            return error_msg
+
+    def stream_chat(self, history, user_message, max_output_tokens=None, session_id=None):
+        """
+        Streaming variant of chat(): yields text chunks as they arrive.
+        Errors (before or mid-stream) end the stream with an error message chunk, like chat() returns one.
+        """
+        if not self.available:
+            error_msg = "❌ Model not initialized - API key missing or google-generativeai not installed"
             logger.error(error_msg)
-            import traceback
-            traceback.print_exc()
-            return error_msg, None
\ No newline at end of file
+            yield error_msg
+            return
+
+        usage_metadata = None
+        output_chars = []
+        try:
+            response = self._chat_request(history, user_message, max_output_tokens, stream=True)
+            for chunk in response:
+                usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+                try:
+                    text = chunk.text
+                except Exception:
+                    continue
+                if text:
+                    output_chars.append(text)
+                    yield text
+        except Exception as e:
+            error_msg = f"❌ Error communicating with Gemini: {str(e)}"
+            log_exception(logger, error_msg)
+            yield error_msg
+            if not output_chars:
+                return
+        self._record_usage(
+            usage_metadata, self._chat_text(history, user_message), "".join(output_chars),
+            session_id, "plain", "chatnormal"
+        )
+
+    def key_metrics(self):
+        """Per-key quota and error counters (keys masked)."""
+        return self.key_pool.metrics() if self.key_pool else []
+
+    def warm_up(self):
+        """
+        Open each key's connection (channel + TLS) before the first user request.
+        Uses count_tokens, which is free and doesn't use generation quota.
+        """
+        if not self.available:
+            return
+        for slot in self.key_pool.slots:
+            try:
+                slot.client.model.count_tokens("ping")
+            except Exception as e:
+                logger.warning(f"⚠️ Gemini warm-up failed for key {slot.masked}: {e}")
+        logger.info(f"🔥 Gemini clients warmed up ({len(self.key_pool)} key(s))")
@@ -0,0 +1,327 @@
+"""
+Background jobs for long-running generations (e.g. the final "create resume" turn).
+
+POST /api/jobs stores a job row and returns its id right away; a bounded pool
+of JOB_WORKERS asyncio workers runs queued jobs through the runner passed to
+JobManager. Job rows live in a SQLite `jobs` table (PERSIST_DB_PATH), so any
+worker process can answer status/result polls for a job another one runs.
+
+- identical payloads (same kind + canonical JSON) submitted while a job is
+  queued, running or finished less than JOB_DEDUPE_TTL seconds ago return
+  the existing job instead of generating twice; submit(dedupe=False) skips
+  this for payloads whose result depends on more than the payload (e.g. a
+  resumed session)
+- the process owning a queued/running job refreshes its heartbeat_at every
+  JOB_HEARTBEAT_INTERVAL seconds; a job whose heartbeat is older than
+  JOB_STALE_AFTER (its process crashed or was killed) is no longer a
+  duplicate target and reads back as failed
+- at most JOB_QUEUE_SIZE jobs wait per process; submit() raises JobQueueFull beyond that
+- cancel() drops a queued job, or discards the result of a running one
+- metrics() reports queue depth, wait and run times, and outcome counters
+
+Jobs still queued or running when the process stops are marked failed.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from persistence import PERSIST_DB_PATH
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+JOB_DEDUPE_TTL = float(os.getenv("JOB_DEDUPE_TTL", "600"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.5"))
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "10"))
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", "60"))
+
+FINAL_STATUSES = ("done", "failed", "cancelled")
+_TIMING_WINDOW = 500
+
+Runner = Callable[[str, Dict[str, Any]], Awaitable[Any]]
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def payload_hash(kind: str, payload: Dict[str, Any]) -> str:
+    canonical = json.dumps([kind, payload], sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _timing_stats(samples) -> Dict[str, Optional[float]]:
+    if not samples:
+        return {"avg_ms": None, "p95_ms": None, "max_ms": None}
+    ordered = sorted(samples)
+    return {
+        "avg_ms": round(sum(ordered) / len(ordered) * 1000, 1),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+        "max_ms": round(ordered[-1] * 1000, 1),
+    }
+
+
+class JobManager:
+    def __init__(self, runner: Runner, path: str = PERSIST_DB_PATH, workers: int = JOB_WORKERS,
+                 queue_size: int = JOB_QUEUE_SIZE):
+        """
+        Args:
+            runner: async runner(kind, payload) -> JSON-serializable result
+            path: SQLite file holding the jobs table
+            workers: Number of concurrent jobs per process
+            queue_size: Max queued jobs per process
+        """
+        self.runner = runner
+        self.path = path
+        self.workers = workers
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+        self._running: Dict[str, asyncio.Task] = {}
+        self._cancelled = set()
+        self._local_jobs = set()
+        self._wait_times = deque(maxlen=_TIMING_WINDOW)
+        self._run_times = deque(maxlen=_TIMING_WINDOW)
+        self.counters = {"submitted": 0, "deduplicated": 0, "rejected": 0,
+                         "completed": 0, "failed": 0, "cancelled": 0}
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    payload_hash TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    heartbeat_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_hash ON jobs(payload_hash, created_at);
+                """
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "heartbeat_at" not in columns:
+                # Tables created before heartbeats: old unfinished rows count as stale
+                conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at REAL")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10.0)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    # --- database (runs in a thread) ---
+
+    def _find_duplicate(self, digest: str) -> Optional[str]:
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE payload_hash = ? AND ((status IN ('queued', 'running') AND heartbeat_at > ?)"
+                " OR (status = 'done' AND finished_at > ?)) ORDER BY created_at DESC LIMIT 1",
+                (digest, now - JOB_STALE_AFTER, now - JOB_DEDUPE_TTL),
+            ).fetchone()
+        return row[0] if row else None
+
+    def _insert(self, job_id: str, kind: str, digest: str, payload: Dict[str, Any], now: float):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs(id, kind, payload_hash, payload, status, created_at, heartbeat_at)"
+                " VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (job_id, kind, digest, json.dumps(payload, ensure_ascii=False), now, now),
+            )
+
+    def _heartbeat(self, job_ids, now: float):
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status IN ('queued', 'running')",
+                [(now, job_id) for job_id in job_ids],
+            )
+
+    def _fail_stale(self, job_id: str, now: float):
+        """Mark a queued/running job whose owning process stopped heartbeating as failed."""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Worker process lost', finished_at = ?"
+                " WHERE id = ? AND status IN ('queued', 'running') AND COALESCE(heartbeat_at, 0) <= ?",
+                (now, job_id, now - JOB_STALE_AFTER),
+            )
+
+    def _update(self, job_id: str, from_statuses, **fields) -> bool:
+        """Set fields unless the job has left from_statuses (e.g. was cancelled meanwhile)."""
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        marks = ", ".join("?" for _ in from_statuses)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"UPDATE jobs SET {columns} WHERE id = ? AND status IN ({marks})",
+                (*fields.values(), job_id, *from_statuses),
+            )
+        return cursor.rowcount > 0
+
+    def _load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        self._fail_stale(job_id, time.time())
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, kind, status, result, error, created_at, started_at, finished_at FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "jobId": row[0],
+            "kind": row[1],
+            "status": row[2],
+            "result": json.loads(row[3]) if row[3] is not None else None,
+            "error": row[4],
+            "createdAt": row[5],
+            "startedAt": row[6],
+            "finishedAt": row[7],
+        }
+
+    # --- public API ---
+
+    async def submit(self, kind: str, payload: Dict[str, Any], dedupe: bool = True) -> Dict[str, Any]:
+        """Queue a job (or return the identical one already known, unless dedupe=False). Raises JobQueueFull."""
+        digest = payload_hash(kind, payload)
+        existing = await asyncio.to_thread(self._find_duplicate, digest) if dedupe else None
+        if existing:
+            self.counters["deduplicated"] += 1
+            job = await self.get(existing)
+            if job is not None:
+                return {**job, "deduplicated": True}
+
+        if self._queue.full():
+            self.counters["rejected"] += 1
+            raise JobQueueFull(f"Job queue full ({self._queue.maxsize} waiting)")
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        await asyncio.to_thread(self._insert, job_id, kind, digest, payload, now)
+        self._queue.put_nowait((job_id, kind, payload, now))
+        self._local_jobs.add(job_id)
+        self.counters["submitted"] += 1
+        logger.info(f"🧾 Job {job_id} queued ({kind}, depth={self._queue.qsize()})")
+        return {"jobId": job_id, "kind": kind, "status": "queued", "createdAt": now, "deduplicated": False}
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._load, job_id)
+
+    async def cancel(self, job_id: str) -> bool:
+        """Cancel a queued or running job; False when it is unknown or already finished."""
+        cancelled = await asyncio.to_thread(
+            self._update, job_id, ("queued", "running"), status="cancelled", finished_at=time.time()
+        )
+        if cancelled:
+            self.counters["cancelled"] += 1
+            task = self._running.get(job_id)
+            if task is not None:
+                self._cancelled.add(job_id)
+                task.cancel()
+            logger.info(f"🛑 Job {job_id} cancelled")
+        return cancelled
+
+    async def events(self, job_id: str):
+        """Yield the job each time its status changes, ending with the final state."""
+        last_status = None
+        while True:
+            job = await self.get(job_id)
+            if job is None:
+                return
+            if job["status"] != last_status:
+                last_status = job["status"]
+                yield job
+            if last_status in FINAL_STATUSES:
+                return
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queue_depth": self._queue.qsize(),
+            "queue_capacity": self._queue.maxsize,
+            "running": len(self._running),
+            **self.counters,
+            "wait": _timing_stats(self._wait_times),
+            "run": _timing_stats(self._run_times),
+        }
+
+    # --- workers ---
+
+    async def _run_one(self, job_id: str, kind: str, payload: Dict[str, Any], enqueued_at: float):
+        started = time.time()
+        if not await asyncio.to_thread(self._update, job_id, ("queued",), status="running", started_at=started):
+            return  # cancelled while queued
+        self._wait_times.append(started - enqueued_at)
+        task = asyncio.create_task(self.runner(kind, payload))
+        self._running[job_id] = task
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            if job_id not in self._cancelled:
+                raise  # the worker itself is being stopped
+            return
+        except Exception as e:
+            logger.error(f"❌ Job {job_id} failed: {e}")
+            if await asyncio.to_thread(self._update, job_id, ("running",), status="failed",
+                                       error=str(e), finished_at=time.time()):
+                self.counters["failed"] += 1
+            return
+        finally:
+            self._running.pop(job_id, None)
+            self._cancelled.discard(job_id)
+            self._run_times.append(time.time() - started)
+        if await asyncio.to_thread(self._update, job_id, ("running",), status="done",
+                                   result=json.dumps(result, ensure_ascii=False), finished_at=time.time()):
+            self.counters["completed"] += 1
+            logger.info(f"✅ Job {job_id} done in {time.time() - started:.1f}s")
+
+    async def _worker(self):
+        while True:
+            job_id, kind, payload, enqueued_at = await self._queue.get()
+            try:
+                await self._run_one(job_id, kind, payload, enqueued_at)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Job worker error on {job_id}: {e}")
+            finally:
+                self._local_jobs.discard(job_id)
+                self._queue.task_done()
+
+    async def _heartbeats(self):
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+            if self._local_jobs:
+                try:
+                    await asyncio.to_thread(self._heartbeat, list(self._local_jobs), time.time())
+                except Exception as e:
+                    logger.error(f"❌ Job heartbeat failed: {e}")
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._heartbeats()))
+
+    async def stop(self):
+        unfinished = list(self._local_jobs)
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        # Nothing will pick these up again in this process
+        now = time.time()
+        for job_id in unfinished:
+            await asyncio.to_thread(self._update, job_id, ("queued", "running"), status="failed",
+                                    error="Interrupted by server shutdown", finished_at=now)
+        self._local_jobs.clear()
@@ -0,0 +1,242 @@
+"""
+API-key pool with quota-aware rotation.
+
+Each provider client holds one KeySlot per API key, each with its own SDK
+client instance. KeyPool.acquire() picks the usable key with the most
+remaining quota in the current minute:
+
+- quota is `rpm_limit` requests per minute per key, counted in the shared
+  state store so all workers draw from the same budget, and lowered further
+  when the provider reports remaining quota in response headers
+- a key that gets a 429 is benched for its Retry-After (or `bench_seconds`,
+  doubling on consecutive 429s) and skipped until then
+- per-key metrics are exposed through KeyPool.metrics() (keys are masked)
+"""
+import hashlib
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MAX_BENCH_SECONDS = 300.0
+
+
+def parse_keys(keys_value: Optional[str], single_key: Optional[str] = None) -> List[str]:
+    """Comma/newline separated key list (e.g. GEMINI_API_KEYS), falling back to a single key."""
+    keys = [k.strip() for k in (keys_value or "").replace("\n", ",").split(",") if k.strip()]
+    if not keys and single_key:
+        keys = [single_key]
+    # Keep order, drop duplicates
+    return list(dict.fromkeys(keys))
+
+
+def mask_key(key: str) -> str:
+    return f"{key[:4]}…{key[-4:]}" if len(key) > 12 else "…"
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """True for provider 429s (google.api_core ResourceExhausted, openai.RateLimitError, ...)."""
+    for attr in ("code", "status_code"):
+        if getattr(error, attr, None) == 429:
+            return True
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        return True
+    return type(error).__name__ in ("ResourceExhausted", "RateLimitError", "TooManyRequests")
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Retry-After header of a 429, when the SDK exposes the HTTP response."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class KeySlot:
+    """One API key, its client instance and its counters."""
+
+    def __init__(self, key: str, client: Any):
+        self.client = client
+        self.masked = mask_key(key)
+        self.id = hashlib.sha256(key.encode()).hexdigest()[:12]
+        self.benched_until = 0.0
+        self.consecutive_429 = 0
+        self.last_used = 0.0
+        # Provider-reported quota (from response headers), valid until reported_reset
+        self.reported_remaining: Optional[int] = None
+        self.reported_reset = 0.0
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.last_error: Optional[str] = None
+
+
+class KeyPool:
+    def __init__(self, provider: str, keys: List[str], make_client: Callable[[str], Any],
+                 rpm_limit: int, bench_seconds: float = 30.0, store=None):
+        """
+        Args:
+            provider: Name used in metrics and shared-store keys ("gemini", "openrouter")
+            keys: API keys
+            make_client: Builds the SDK client for one key
+            rpm_limit: Requests per minute allowed per key
+            bench_seconds: Base bench time after a 429 without Retry-After
+            store: shared_state.SharedStore for cross-worker counters (local counters if None)
+        """
+        self.provider = provider
+        self.rpm_limit = rpm_limit
+        self.bench_seconds = bench_seconds
+        self.store = store
+        self.slots: List[KeySlot] = []
+        self._local_counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        for key in keys:
+            try:
+                self.slots.append(KeySlot(key, make_client(key)))
+            except Exception as e:
+                logger.error(f"❌ Failed to create {provider} client for key {mask_key(key)}: {e}")
+
+    def __len__(self):
+        return len(self.slots)
+
+    # --- counters (shared store when available) ---
+
+    def _window_key(self, slot: KeySlot, now: float) -> str:
+        return f"rate:{self.provider}:{slot.id}:{int(now // 60)}"
+
+    def _used(self, slot: KeySlot, now: float) -> int:
+        key = self._window_key(slot, now)
+        if self.store is not None:
+            try:
+                return int(self.store.get(key) or 0)
+            except Exception:
+                pass
+        return self._local_counts.get(key, 0)
+
+    def _count(self, slot: KeySlot, now: float):
+        key = self._window_key(slot, now)
+        if self.store is not None:
+            try:
+                self.store.incr(key, ttl=120)
+                return
+            except Exception as e:
+                logger.warning(f"⚠️ Shared rate counter unavailable ({e}) - counting locally")
+        # Local fallback: keep only the current window
+        self._local_counts = {k: v for k, v in self._local_counts.items() if k == key}
+        self._local_counts[key] = self._local_counts.get(key, 0) + 1
+
+    def _benched_until(self, slot: KeySlot) -> float:
+        if self.store is not None:
+            try:
+                shared = self.store.get(f"rate:{self.provider}:{slot.id}:benched")
+                if shared:
+                    return max(slot.benched_until, float(shared))
+            except Exception:
+                pass
+        return slot.benched_until
+
+    def _remaining(self, slot: KeySlot, now: float) -> int:
+        remaining = self.rpm_limit - self._used(slot, now)
+        if slot.reported_remaining is not None and slot.reported_reset > now:
+            remaining = min(remaining, slot.reported_remaining)
+        return remaining
+
+    # --- selection and feedback ---
+
+    def acquire(self) -> KeySlot:
+        """Pick the key with the most remaining quota (least recently used on ties)."""
+        if not self.slots:
+            raise RuntimeError(f"No {self.provider} API keys configured")
+        with self._lock:
+            now = time.time()
+            best, best_score = None, None
+            for slot in self.slots:
+                if self._benched_until(slot) > now:
+                    continue
+                score = (self._remaining(slot, now), -slot.last_used)
+                if best_score is None or score > best_score:
+                    best, best_score = slot, score
+            if best is None:
+                best = min(self.slots, key=self._benched_until)
+                logger.warning(f"⚠️ All {self.provider} keys are benched - trying {best.masked} anyway")
+            elif best_score[0] <= 0:
+                logger.warning(f"⚠️ All {self.provider} keys are at their per-minute quota")
+            best.last_used = now
+            best.requests += 1
+            self._count(best, now)
+            return best
+
+    def report_success(self, slot: KeySlot, remaining: Optional[int] = None, reset_in: Optional[float] = None):
+        slot.successes += 1
+        slot.consecutive_429 = 0
+        if remaining is not None:
+            slot.reported_remaining = remaining
+            slot.reported_reset = time.time() + (reset_in if reset_in is not None else 60.0)
+
+    def report_rate_limited(self, slot: KeySlot, retry_after: Optional[float] = None):
+        slot.rate_limited += 1
+        slot.consecutive_429 += 1
+        bench = retry_after or min(self.bench_seconds * 2 ** (slot.consecutive_429 - 1), MAX_BENCH_SECONDS)
+        slot.benched_until = time.time() + bench
+        if self.store is not None:
+            try:
+                self.store.set(f"rate:{self.provider}:{slot.id}:benched", slot.benched_until, ttl=bench)
+            except Exception:
+                pass
+        logger.warning(f"⚠️ {self.provider} key {slot.masked} rate limited - benched for {bench:.0f}s")
+
+    def report_failure(self, slot: KeySlot, error: Exception):
+        slot.failures += 1
+        slot.last_error = str(error)[:200]
+
+    def call(self, fn: Callable[[Any], Any], quota_from: Optional[Callable[[Any], Any]] = None):
+        """
+        Run fn(client) on the best key, moving on to the next key after a 429.
+        Other errors are recorded and re-raised.
+
+        quota_from(result) may return (remaining, reset_in_seconds) read from
+        the provider's response, or None when it reports nothing.
+        """
+        last_error = None
+        for _ in range(max(len(self.slots), 1)):
+            slot = self.acquire()
+            try:
+                result = fn(slot.client)
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    self.report_rate_limited(slot, retry_after_seconds(e))
+                    last_error = e
+                    continue
+                self.report_failure(slot, e)
+                raise
+            quota = quota_from(result) if quota_from else None
+            if quota:
+                self.report_success(slot, *quota)
+            else:
+                self.report_success(slot)
+            return result
+        raise last_error
+
+    def metrics(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        return [
+            {
+                "key": slot.masked,
+                "id": slot.id,
+                "remaining": self._remaining(slot, now),
+                "benched_for": max(0.0, round(self._benched_until(slot) - now, 1)),
+                "requests": slot.requests,
+                "successes": slot.successes,
+                "failures": slot.failures,
+                "rate_limited": slot.rate_limited,
+                "last_error": slot.last_error,
+            }
+            for slot in self.slots
+        ]
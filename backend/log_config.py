@@ -0,0 +1,188 @@
+"""
+Non-blocking structured logging.
+
+setup_logging() puts a QueueHandler on the root logger: the request path only
+formats the message and appends it to an in-memory queue, and a background
+QueueListener thread writes one JSON object per line to stdout:
+
+    {"ts": "...", "level": "INFO", "logger": "gemini_client", "request_id": "...", "msg": "..."}
+
+- LOG_LEVEL sets the root level (default INFO)
+- LOG_SAMPLE_RATES keeps a fraction of records per level, e.g. "DEBUG=0,INFO=0.1";
+  WARNING and above are always kept unless listed
+- log_exception() attaches a traceback to at most LOG_TRACEBACKS_PER_MINUTE
+  errors; the rest are logged without one and counted in "suppressed_tracebacks"
+- RequestIdMiddleware tags records with X-Request-ID (generated when absent)
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+LOG_TRACEBACKS_PER_MINUTE = int(os.getenv("LOG_TRACEBACKS_PER_MINUTE", "10"))
+
+REQUEST_ID_HEADER = b"x-request-id"
+
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+_listener: Optional[QueueListener] = None
+_setup_lock = threading.Lock()
+
+
+def parse_sample_rates(spec: str) -> Dict[int, float]:
+    """"INFO=0.1,DEBUG=0" -> {logging.INFO: 0.1, logging.DEBUG: 0.0}"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, rate = item.partition("=")
+        level = logging.getLevelName(name.strip().upper())
+        if isinstance(level, int):
+            rates[level] = float(rate)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a per-level fraction of records; records carrying exc_info are never dropped."""
+
+    def __init__(self, rates: Dict[int, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno)
+        if rate is None or record.exc_info:
+            return True
+        return rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", None),
+            "msg": record.getMessage(),
+        }
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _ContextQueueHandler(QueueHandler):
+    """
+    Captures the request id and renders the traceback in the calling context;
+    the JSON encoding and the stdout write happen on the listener thread.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.request_id = request_id_var.get()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _TracebackLimiter:
+    """Token bucket: up to `per_minute` tracebacks, refilled continuously."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self.suppressed = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60.0)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            self.suppressed += 1
+            return False
+
+
+_traceback_limiter = _TracebackLimiter(LOG_TRACEBACKS_PER_MINUTE)
+
+
+def log_exception(logger: logging.Logger, msg: str):
+    """logger.error() with the current exception's traceback, rate-limited."""
+    if _traceback_limiter.allow():
+        logger.error(msg, exc_info=True)
+    else:
+        logger.error(f"{msg} (traceback suppressed, {_traceback_limiter.suppressed} so far)")
+
+
+def setup_logging():
+    """Install the queue handler + background listener once per process."""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        handler = _ContextQueueHandler(log_queue)
+        handler.addFilter(SamplingFilter(parse_sample_rates(LOG_SAMPLE_RATES)))
+
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JsonFormatter())
+
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+
+        _listener = QueueListener(log_queue, output, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+def logging_stats() -> Dict[str, int]:
+    """Counters exposed by GET /api/stats."""
+    return {"suppressed_tracebacks": _traceback_limiter.suppressed}
+
+
+class RequestIdMiddleware:
+    """ASGI middleware: sets request_id_var from X-Request-ID (or a new id) and echoes it back."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        request_id = None
+        for key, value in scope["headers"]:
+            if key == REQUEST_ID_HEADER:
+                request_id = value.decode("latin-1")[:128]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+
+        async def wrapped_send(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", []).append((REQUEST_ID_HEADER, request_id.encode("latin-1")))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, wrapped_send)
+        finally:
+            request_id_var.reset(token)
@@ -1,77 +1,262 @@
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi import FastAPI, Request, WebSocket
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from gemini_client import GeminiClient
 from opairtclient import OpenAIRTClient
-from models import ChatRequest, ChatResponse
+from models import ChatNormalRequest, ChatRequest, ChatResponse, JobRequest, OpenRouterRequest
 from fact_extractor import pre_extract_facts, build_facts_context
+from ws_chat import handle_chat_socket, held_conversations
+from codec import CompressionMiddleware, FastJSONResponse, decode_model
+from persistence import SESSION_SECRET, PersistenceWriter, SessionIds, SQLiteConversationStore
+from usage import UsageLedger
+from profiling import ProfilingMiddleware, stage, to_thread
+from log_config import RequestIdMiddleware, log_exception, logging_stats, setup_logging
+from key_pool import parse_keys
+from shared_state import get_shared_store
+from resume_delta import ResumeVersions
+from jobs import JobManager, JobQueueFull
+from static_assets import StaticAssetCache
+from semantic_cache import SEMANTIC_CACHE_ENABLED, SemanticCache, track_hits
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+from pydantic import ValidationError
 import os
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = FastAPI()
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# Write-behind store for turns and resume snapshots (request path only enqueues)
+conversation_store = SQLiteConversationStore()
+persistence_writer = PersistenceWriter(conversation_store)
+# Only server-issued (unguessable) session ids are accepted, see POST /api/sessions
+session_ids = SessionIds(SESSION_SECRET.encode() if SESSION_SECRET else conversation_store.session_secret())
+# Token usage per session/role/model/endpoint, flushed to SQLite periodically
+usage_ledger = UsageLedger()
+
+# Open provider connections at startup so the first request doesn't pay for TLS/channel setup
+CLIENT_WARMUP = os.getenv("CLIENT_WARMUP", "1") == "1"
+CLIENT_WARMUP_TIMEOUT = float(os.getenv("CLIENT_WARMUP_TIMEOUT", "10"))
+
+async def warm_up_clients():
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                asyncio.to_thread(gemini_client.warm_up),
+                asyncio.to_thread(openai_rt_client.warm_up),
+            ),
+            timeout=CLIENT_WARMUP_TIMEOUT,
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f"⚠️ Client warm-up still running after {CLIENT_WARMUP_TIMEOUT:.0f}s - serving anyway")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await persistence_writer.start()
+    await usage_ledger.start()
+    await job_manager.start()
+    await asyncio.to_thread(static_assets.load)
+    if CLIENT_WARMUP:
+        await warm_up_clients()
+    yield
+    await job_manager.stop()
+    await usage_ledger.stop()
+    await persistence_writer.stop()
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(RequestIdMiddleware)
 app.add_middleware(
   CORSMiddleware,
   allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
 )
 
+# Key pools: GEMINI_API_KEYS / OPENROUTER_API_KEYS (comma-separated) or a single *_API_KEY.
+# Per-key quota counters live in the shared store so every worker sees them.
+shared_store = get_shared_store()
+# Latest resumeData per session, the base for patch response modes; numbered by persisted snapshot version
+resume_versions = ResumeVersions(shared_store, persistence_writer)
+
+# Near-duplicate cache for short opening turns, shared by both clients (off unless SEMANTIC_CACHE_ENABLED=1)
+semantic_cache = SemanticCache() if SEMANTIC_CACHE_ENABLED else None
+
 gemini_api_key = os.getenv("GEMINI_API_KEY")
-print(f"🔑 Gemini API Key loaded: {gemini_api_key[:10] if gemini_api_key else 'NOT FOUND'}...")
-gemini_client = GeminiClient(gemini_api_key)
+gemini_api_keys = parse_keys(os.getenv("GEMINI_API_KEYS"), gemini_api_key)
+logger.info(f"🔑 Gemini API keys loaded: {len(gemini_api_keys) or 'NOT FOUND'}")
+gemini_client = GeminiClient(
+    gemini_api_key, usage_ledger=usage_ledger, api_keys=gemini_api_keys, store=shared_store, semantic_cache=semantic_cache
+)
 
 openrouter_api_key = os.getenv("OPENROUTER_API_KEY")
-print(f"🔑 OpenRouter API Key loaded: {openrouter_api_key[:10] if openrouter_api_key else 'NOT FOUND'}...")
-openai_rt_client = OpenAIRTClient(openrouter_api_key)
+openrouter_api_keys = parse_keys(os.getenv("OPENROUTER_API_KEYS"), openrouter_api_key)
+logger.info(f"🔑 OpenRouter API keys loaded: {len(openrouter_api_keys) or 'NOT FOUND'}")
+openai_rt_client = OpenAIRTClient(
+    openrouter_api_key, usage_ledger=usage_ledger, api_keys=openrouter_api_keys, store=shared_store,
+    semantic_cache=semantic_cache,
+)
 
-@app.post("/api/chat", response_model=ChatResponse)
-async def chat_endpoint(request: Request):
+def semantic_cache_headers(hits: dict) -> dict:
+  """X-Semantic-Cache: hit; entry=<id> - report a wrong answer with POST /api/cache/feedback."""
+  if not hits:
+    return {}
+  return {"X-Semantic-Cache": f"hit; entry={hits['entry']}; similarity={hits['similarity']}"}
+
+def invalid_session(session_id):
+  """403 response for a sessionId this server didn't issue; None when absent or valid."""
+  if session_id is None or session_ids.valid(session_id):
+    return None
+  return FastJSONResponse(status_code=403, content={"error": "Unknown sessionId - create one with POST /api/sessions"})
+
+async def read_json_object(request: Request):
+  """Request body as a dict; None when it is not valid JSON or not a JSON object."""
   try:
     data = await request.json()
-    chat_req = ChatRequest(**data)
-    
-    # Convert Pydantic models to dicts for GeminiClient
-    history_dicts = [{"role": msg.role, "content": msg.content} for msg in chat_req.conversationHistory]
-    
-    # Pre-extract facts from history to avoid repeat questions
-    facts = pre_extract_facts(history_dicts + [{"role": "user", "content": chat_req.userMessage}])
+  except ValueError:
+    return None
+  return data if isinstance(data, dict) else None
+
+async def run_chat_turn(chat_req: ChatRequest) -> ChatResponse:
+  """One resume builder turn (/api/chat and "chat" jobs). Raises on failure."""
+  # Message objects support .get(), so history goes through without dict copies
+  history = chat_req.conversationHistory
+  session_id = chat_req.sessionId
+  if session_id and not history:
+    # Resume a stored session instead of making the client replay it
+    stored = await persistence_writer.load_session(session_id)
+    if stored:
+      history = stored["conversationHistory"]
+  
+  # Pre-extract facts from history to avoid repeat questions
+  with stage("fact_extraction"):
+    facts = pre_extract_facts(history + [{"role": "user", "content": chat_req.userMessage}])
     facts_context = build_facts_context(facts)
-    
-    assistant_message, resume_data = gemini_client.send_message(
-      history_dicts, chat_req.userMessage, chat_req.role, facts_context
-    )
-    return ChatResponse(assistantMessage=assistant_message, resumeData=resume_data)
+  
+  # Upstream call in a thread so job workers and other requests keep running
+  assistant_message, resume_data = await to_thread(
+    gemini_client.send_message,
+    history, chat_req.userMessage, chat_req.role, facts_context, session_id=session_id, endpoint="chat"
+  )
+  if session_id:
+    persistence_writer.enqueue_turn(session_id, "user", chat_req.userMessage)
+    persistence_writer.enqueue_turn(session_id, "assistant", assistant_message)
+  # Also persists resume_data as the session's next version
+  resume_fields = await resume_versions.encode(
+    resume_data, session_id, chat_req.responseMode, chat_req.baseVersion, chat_req.baseResume
+  )
+  if session_id:
+    # Durable before responding, so a resume on any worker sees this turn
+    await persistence_writer.commit()
+  return ChatResponse(assistantMessage=assistant_message, sessionId=session_id, **resume_fields)
+
+@app.post("/api/chat", response_model=ChatResponse)
+async def chat_endpoint(request: Request):
+  try:
+    # Decode + validate the raw body in one pass
+    body = await request.body()
+    with stage("decode"):
+      chat_req = decode_model(ChatRequest, body)
+    rejected = invalid_session(chat_req.sessionId)
+    if rejected is not None:
+      return rejected
+    hits = track_hits()
+    response = await run_chat_turn(chat_req)
+    return FastJSONResponse(response, headers=semantic_cache_headers(hits))
   except Exception as e:
-    import traceback
-    traceback.print_exc()
-    return ChatResponse(assistantMessage=f"Error: {str(e)}", resumeData=None)
+    log_exception(logger, f"❌ /api/chat failed: {e}")
+    return FastJSONResponse(ChatResponse(assistantMessage=f"Error: {str(e)}", resumeData=None))
 @app.post("/api/chatnormal")
 async def chatnormal_endpoint(request: Request):
     """
     Simple chat endpoint: returns only plain text AI response (no resume JSON extraction).
-    Request body: {"conversationHistory": [...], "userMessage": "..."}
+    Uses its own short system prompt and native multi-turn messages, not the resume builder prompt.
+    Request body: {"conversationHistory": [...], "userMessage": "...", "stream": false, "maxTokens": 512}
+    With "stream": true the reply is streamed as text/plain chunks.
     """
     try:
-        data = await request.json()
-        history = data.get("conversationHistory", [])
-        user_message = data.get("userMessage", "")
-        # Build conversation string for Gemini prompt
-        conversation = ""
-        for msg in history:
-            conversation += f"{msg['role']}: {msg['content']}\n"
-        conversation += f"user: {user_message}\n"
-        # Use GeminiClient for plain chat
-        assistant_message, _ = gemini_client.send_message([], conversation, role="general")
-        return JSONResponse(content={"assistantMessage": assistant_message})
+        body = await request.body()
+        with stage("decode"):
+            chat_req = decode_model(ChatNormalRequest, body)
+    except ValidationError as e:
+        return FastJSONResponse(status_code=422, content={"error": str(e)})
+    history = chat_req.conversationHistory
+    user_message = chat_req.userMessage
+    max_tokens = chat_req.maxTokens
+    session_id = chat_req.sessionId
+    try:
+        if chat_req.stream:
+            if not gemini_client.available:
+                return FastJSONResponse(content={"assistantMessage": "Error: Gemini model not initialized"})
+            return StreamingResponse(
+                gemini_client.stream_chat(history, user_message, max_tokens, session_id=session_id),
+                media_type="text/plain; charset=utf-8",
+            )
+        assistant_message = await to_thread(gemini_client.chat, history, user_message, max_tokens, session_id=session_id)
+        return FastJSONResponse(content={"assistantMessage": assistant_message})
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return JSONResponse(content={"assistantMessage": f"Error: {str(e)}"})
+        log_exception(logger, f"❌ /api/chatnormal failed: {e}")
+        return FastJSONResponse(content={"assistantMessage": f"Error: {str(e)}"})
 
-@app.get("/")
-def test_page():
-    html = """
+@app.websocket("/ws/chat")
+async def ws_chat_endpoint(websocket: WebSocket):
+    """
+    Streaming resume builder chat over one persistent socket.
+    History, facts and resumeData are held per connection - see ws_chat.py for the frame protocol.
+    """
+    session_id = websocket.query_params.get("session")
+    if session_id is not None and not session_ids.valid(session_id):
+        # Closing before accept rejects the handshake (HTTP 403)
+        await websocket.close(code=1008)
+        return
+    await handle_chat_socket(websocket, gemini_client, persistence_writer, resume_versions)
+
+@app.post("/api/sessions")
+def create_session_endpoint():
+    """
+    Issue a new session id to pass as sessionId (or /ws/chat?session=).
+    Response: { "sessionId": "..." }
+    """
+    return FastJSONResponse(content={"sessionId": session_ids.new()})
+
+@app.get("/api/sessions/{session_id}")
+async def session_endpoint(session_id: str):
+    """
+    Restore a persisted session without calling the model.
+    Response: { "sessionId": "...", "conversationHistory": [...], "resumeData": {...}, "resumeVersion": N }
+    """
+    stored = await persistence_writer.load_session(session_id) if session_ids.valid(session_id) else None
+    if stored is None:
+        return FastJSONResponse(status_code=404, content={"error": f"Session {session_id} not found"})
+    return FastJSONResponse(content=stored)
+
+@app.get("/api/usage")
+async def usage_endpoint(groupBy: str = "model,endpoint", sessionId: str = None):
+    """
+    Token and cost totals from the usage ledger (all workers).
+    Query: groupBy = comma-separated subset of session_id,role,model,endpoint; sessionId = filter
+    Response: { "usage": [ {"model": "...", "endpoint": "...", "requests": N, ..., "cost_usd": 0.0012} ] }
+    Session ids are the secret for reading a session back, so grouping by session_id needs a sessionId filter.
+    """
+    group_by = groupBy.split(",")
+    if "session_id" in group_by and not sessionId:
+        return FastJSONResponse(status_code=400, content={"error": "groupBy=session_id requires a sessionId filter"})
+    rows = await usage_ledger.summary(group_by=group_by, session_id=sessionId)
+    return FastJSONResponse(content={"usage": rows})
+
+@app.get("/api/keys")
+def keys_endpoint():
+    """Per-key quota, bench and error metrics for each provider (keys are masked)."""
+    return FastJSONResponse(content={
+        "gemini": gemini_client.key_metrics(),
+        "openrouter": openai_rt_client.key_metrics(),
+    })
+
+TEST_PAGE_HTML = """
     <!DOCTYPE html>
     <html>
     <head><title>ChatFolio Chat Test</title></head>
@@ -102,49 +287,193 @@ def test_page():
     </body>
     </html>
     """
-    return HTMLResponse(content=html)
+
+# Test pages served from memory with ETag/Last-Modified and precompressed bodies
+static_assets = StaticAssetCache()
+static_assets.add_inline("/", TEST_PAGE_HTML)
+static_assets.add_file("/test_opair_chat.html", os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_opair_chat.html"))
+
+@app.get("/")
+def test_page(request: Request):
+    return static_assets.response("/", request.headers)
 
 @app.get("/test_opair_chat.html")
-def test_opair_page():
+def test_opair_page(request: Request):
     """Serve the OpenRouter test chat interface"""
-    try:
-        with open("test_opair_chat.html", "r") as f:
-            html_content = f.read()
-        return HTMLResponse(content=html_content)
-    except FileNotFoundError:
+    response = static_assets.response("/test_opair_chat.html", request.headers)
+    if response is None:
         return HTMLResponse(content="<h1>test_opair_chat.html not found</h1>", status_code=404)
+    return response
+
+async def run_openrouter_turn(openrouter_req: OpenRouterRequest) -> dict:
+    """One OpenRouter turn (/api/openrouter and "openrouter" jobs). Raises on failure."""
+    messages = openrouter_req.messages
+    session_id = openrouter_req.sessionId
+    
+    # Call OpenRouter client (in a thread so job workers and other requests keep running)
+    assistant_text, structured_json = await to_thread(
+        openai_rt_client.send_message,
+        messages=messages,
+        model=openrouter_req.model,
+        site_url=openrouter_req.site_url,
+        site_title=openrouter_req.site_title,
+        max_output_tokens=2048,
+        session_id=session_id,
+    )
+    
+    if session_id:
+        if messages and messages[-1].get("role") == "user":
+            persistence_writer.enqueue_turn(session_id, "user", messages[-1].get("content", ""))
+        persistence_writer.enqueue_turn(session_id, "assistant", assistant_text or "")
+    
+    # Also persists structured_json as the session's next version
+    resume_fields = await resume_versions.encode(
+        structured_json,
+        session_id,
+        openrouter_req.responseMode,
+        openrouter_req.baseVersion,
+        openrouter_req.baseResume,
+    )
+    if session_id:
+        # Durable before responding, so a resume on any worker sees this turn
+        await persistence_writer.commit()
+    return {
+        "assistantMessage": assistant_text or "",
+        **resume_fields
+    }
 
 @app.post("/api/openrouter")
 async def openrouter_endpoint(request: Request):
     """
     OpenRouter chat endpoint: routes messages to OpenAI/OpenRouter API.
-    Request: { "messages": [...], "model": "...", "site_url": "...", "site_title": "..." }
+    Request: { "messages": [...], "model": "...", "site_url": "...", "site_title": "...",
+               "responseMode": "full" | "json-patch" | "merge-patch", "baseVersion": N, "baseResume": {...} }
     Response: { "assistantMessage": "...", "resumeData": {...} }
+              (+ "resumeVersion" with a sessionId, "resumePatch"/"patchFormat" in patch modes)
     """
     try:
-        data = await request.json()
-        messages = data.get("messages", [])
-        model = data.get("model", "openai/gpt-oss-20b:free")
-        site_url = data.get("site_url")
-        site_title = data.get("site_title")
-        
-        # Call OpenRouter client
-        assistant_text, structured_json = openai_rt_client.send_message(
-            messages=messages,
-            model=model,
-            site_url=site_url,
-            site_title=site_title,
-            max_output_tokens=2048
-        )
-        
-        return JSONResponse(content={
-            "assistantMessage": assistant_text or "",
-            "resumeData": structured_json
-        })
+        body = await request.body()
+        with stage("decode"):
+            openrouter_req = decode_model(OpenRouterRequest, body)
+    except ValidationError as e:
+        return FastJSONResponse(status_code=422, content={"error": str(e)})
+    try:
+        rejected = invalid_session(openrouter_req.sessionId)
+        if rejected is not None:
+            return rejected
+        hits = track_hits()
+        response = await run_openrouter_turn(openrouter_req)
+        return FastJSONResponse(content=response, headers=semantic_cache_headers(hits))
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return JSONResponse(
+        log_exception(logger, f"❌ /api/openrouter failed: {e}")
+        return FastJSONResponse(
             status_code=500,
             content={"assistantMessage": f"Error: {str(e)}", "resumeData": None}
         )
+
+# Background jobs: long generations run on a bounded worker pool instead of inside the request
+JOB_KINDS = ("chat", "openrouter")
+
+async def run_job(kind: str, payload: dict):
+    if kind == "chat":
+        response = await run_chat_turn(ChatRequest.model_validate(payload))
+        return response.model_dump()
+    return await run_openrouter_turn(OpenRouterRequest.model_validate(payload))
+
+job_manager = JobManager(run_job)
+
+@app.post("/api/jobs")
+async def submit_job_endpoint(request: Request):
+    """
+    Submit a generation to run in the background.
+    Request: { "kind": "openrouter" | "chat", "request": { ...same body as /api/openrouter or /api/chat... } }
+    Response (202): { "jobId": "...", "status": "queued", "deduplicated": false, ... }
+    """
+    try:
+        job_req = decode_model(JobRequest, await request.body())
+    except ValidationError as e:
+        return FastJSONResponse(status_code=400, content={"error": f"kind must be one of {JOB_KINDS} and request an object: {e}"})
+    kind, payload = job_req.kind, job_req.request
+    try:
+        # Validate now so a bad body fails here, not later inside the job (the job keeps the raw dict)
+        turn_req = (ChatRequest if kind == "chat" else OpenRouterRequest).model_validate(payload)
+    except ValidationError as e:
+        return FastJSONResponse(status_code=422, content={"error": str(e)})
+    rejected = invalid_session(turn_req.sessionId)
+    if rejected is not None:
+        return rejected
+    # A resumed /api/chat session (sessionId, empty history) depends on the stored turns, not just the body
+    resumes_session = kind == "chat" and turn_req.sessionId and not turn_req.conversationHistory
+    try:
+        job = await job_manager.submit(kind, payload, dedupe=not resumes_session)
+    except JobQueueFull as e:
+        return FastJSONResponse(status_code=503, content={"error": str(e)}, headers={"Retry-After": "5"})
+    return FastJSONResponse(status_code=202, content=job)
+
+@app.get("/api/jobs/metrics")
+def job_metrics_endpoint():
+    """Queue depth, wait/run times and outcome counters of this worker's job pool."""
+    return FastJSONResponse(content=job_manager.metrics())
+
+@app.get("/api/jobs/{job_id}")
+async def job_endpoint(job_id: str):
+    """
+    Poll a job.
+    Response: { "jobId": "...", "status": "queued|running|done|failed|cancelled", "result": {...}, "error": null, ... }
+    """
+    job = await job_manager.get(job_id)
+    if job is None:
+        return FastJSONResponse(status_code=404, content={"error": f"Job {job_id} not found"})
+    return FastJSONResponse(content=job)
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events_endpoint(job_id: str):
+    """Server-Sent Events: one "status" event per status change; the last one carries the result."""
+    if await job_manager.get(job_id) is None:
+        return FastJSONResponse(status_code=404, content={"error": f"Job {job_id} not found"})
+
+    async def event_stream():
+        async for job in job_manager.events(job_id):
+            yield f"event: status\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job_endpoint(job_id: str):
+    """Cancel a queued or running job (a running job's result is discarded)."""
+    if await job_manager.cancel(job_id):
+        return FastJSONResponse(content={"jobId": job_id, "status": "cancelled"})
+    job = await job_manager.get(job_id)
+    if job is None:
+        return FastJSONResponse(status_code=404, content={"error": f"Job {job_id} not found"})
+    return FastJSONResponse(status_code=409, content={"error": f"Job {job_id} already {job['status']}"})
+
+@app.get("/api/stats")
+def stats_endpoint():
+    """Internal counters of this worker: suppressed tracebacks, persistence queue and held /ws/chat conversations."""
+    return FastJSONResponse(content={
+        "logging": logging_stats(),
+        "persistence": persistence_writer.stats(),
+        "heldConversations": held_conversations.stats(),
+    })
+
+@app.get("/api/cache/metrics")
+def cache_metrics_endpoint():
+    """Semantic cache hit rate, LSH candidates rejected by verification and reported false positives (this worker)."""
+    if semantic_cache is None:
+        return FastJSONResponse(content={"enabled": False})
+    return FastJSONResponse(content={"enabled": True, **semantic_cache.metrics()})
+
+@app.post("/api/cache/feedback")
+async def cache_feedback_endpoint(request: Request):
+    """
+    Report a cached answer that did not fit the message; the entry is dropped and counted.
+    Request: { "entry": "<id from the X-Semantic-Cache header>" }
+    """
+    data = await read_json_object(request)
+    if data is None:
+        return FastJSONResponse(status_code=400, content={"error": "Request body must be a JSON object"})
+    entry = data.get("entry")
+    if semantic_cache is None or not entry or not semantic_cache.report_false_positive(entry):
+        return FastJSONResponse(status_code=404, content={"error": f"Cache entry {entry} not found"})
+    return FastJSONResponse(content={"entry": entry, "dropped": True})
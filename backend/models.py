@@ -1,15 +1,48 @@
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field
+from typing import Annotated, List, Literal, Optional, Dict, Any
 
 class Message(BaseModel):
     role: str  # 'user' or 'assistant'
     content: str
 
+    def get(self, key: str, default: Any = None) -> Any:
+        """Dict-style access so history can go to fact_extractor/GeminiClient without copying to dicts."""
+        return getattr(self, key, default)
+
 class ChatRequest(BaseModel):
     conversationHistory: List[Message]
     userMessage: str
     role: Optional[str] = "general"
+    sessionId: Optional[str] = None  # persist turns under this id; empty history resumes it
+    responseMode: Optional[str] = "full"  # "full", "json-patch" or "merge-patch" (see resume_delta.py)
+    baseVersion: Optional[int] = None  # resumeVersion the client holds (session-held base)
+    baseResume: Optional[Dict[str, Any]] = None  # or the base document itself (client-supplied base)
+
+class ChatNormalRequest(BaseModel):
+    conversationHistory: List[Message] = []
+    userMessage: str = ""
+    stream: bool = False
+    maxTokens: Optional[Annotated[int, Field(strict=True, gt=0)]] = None  # positive int, clamped to PLAIN_CHAT_MAX_TOKENS
+    sessionId: Optional[str] = None  # usage accounting only; plain chat is not persisted
+
+class OpenRouterRequest(BaseModel):
+    messages: List[Dict[str, Any]] = []  # passed through to the OpenAI-compatible API as-is
+    model: str = "openai/gpt-oss-20b:free"
+    site_url: Optional[str] = None
+    site_title: Optional[str] = None
+    sessionId: Optional[str] = None
+    responseMode: Optional[str] = "full"
+    baseVersion: Optional[int] = None
+    baseResume: Optional[Dict[str, Any]] = None
+
+class JobRequest(BaseModel):
+    kind: Literal["chat", "openrouter"] = "openrouter"
+    request: Dict[str, Any]  # body of /api/chat or /api/openrouter, validated against that endpoint's model
 
 class ChatResponse(BaseModel):
     assistantMessage: str
     resumeData: Optional[Dict[str, Any]] = None
+    sessionId: Optional[str] = None
+    resumeVersion: Optional[int] = None
+    resumePatch: Optional[Any] = None  # JSON Patch ops or merge patch, replaces resumeData
+    patchFormat: Optional[str] = None
@@ -3,13 +3,39 @@ import os
 import logging
 import json
 import re
+import time
 from typing import List, Optional, Tuple, Dict, Any
+from usage import estimate_tokens
+from profiling import stage
+from log_config import setup_logging
+from key_pool import KeyPool
+from fact_extractor import pre_extract_facts, build_facts_context
 
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
 OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+# Per-key request budget and bench time after a 429 (see key_pool.py)
+OPENROUTER_KEY_RPM = int(os.getenv("OPENROUTER_KEY_RPM", "20"))
+OPENROUTER_KEY_BENCH_SECONDS = float(os.getenv("OPENROUTER_KEY_BENCH_SECONDS", "30"))
+
+
+def _header_quota(raw_response):
+    """(remaining, reset_in_seconds) from X-RateLimit-* headers, if the router sent them."""
+    headers = getattr(raw_response, "headers", None) or {}
+    remaining = headers.get("x-ratelimit-remaining")
+    if remaining is None:
+        return None
+    try:
+        reset = headers.get("x-ratelimit-reset")
+        reset_in = None
+        if reset is not None:
+            # OpenRouter sends the reset time as epoch milliseconds
+            reset_in = max(0.0, float(reset) / 1000.0 - time.time())
+        return int(float(remaining)), reset_in
+    except (TypeError, ValueError):
+        return None
 
 
 class OpenAIRTClient:
@@ -21,14 +47,24 @@ class OpenAIRTClient:
     - Safely extracts JSON responses when available (code block or raw JSON)
     - Falls back to plain text when structured JSON is not present
     - Accepts max_output_tokens and response_mime_type hints
+    - Reports completion.usage (or an estimate) to an optional usage ledger
+    - Rotates across a pool of API keys by remaining quota, benching keys that hit 429
+    - Serves near-duplicate short opening turns from an optional semantic cache
     """
 
-    def __init__(self, api_key: str = None, base_url: str = None):
+    def __init__(self, api_key: str = None, base_url: str = None, usage_ledger=None, api_keys=None, store=None,
+                 semantic_cache=None):
         self.api_key = api_key or OPENROUTER_API_KEY
         self.base_url = base_url or OPENROUTER_BASE_URL
-        if not self.api_key:
+        self.usage_ledger = usage_ledger
+        self.semantic_cache = semantic_cache
+        keys = api_keys or ([self.api_key] if self.api_key else [])
+        if not keys:
             logger.warning("⚠️ OPENROUTER_API_KEY not set - AI features will be limited")
-        self.client = OpenAI(base_url=self.base_url, api_key=self.api_key)
+        self.key_pool = KeyPool(
+            "openrouter", keys, lambda key: OpenAI(base_url=self.base_url, api_key=key),
+            rpm_limit=OPENROUTER_KEY_RPM, bench_seconds=OPENROUTER_KEY_BENCH_SECONDS, store=store,
+        )
 
     def send_message(
         self,
@@ -39,6 +75,9 @@ class OpenAIRTClient:
         provider_sort: str = "price",
         max_output_tokens: int = 2048,
         response_mime_type: str = "application/json",
+        session_id: Optional[str] = None,
+        role: str = "general",
+        endpoint: str = "openrouter",
     ) -> Tuple[Optional[str], Optional[dict]]:
         """
         Send a chat completion request to OpenRouter API and return (assistant_message, structured_json_or_none).
@@ -96,6 +135,17 @@ And then say: "Your resume is ready! You can edit any field in the form. Ask me
 
 ."""
 
+        cache_token = None
+        last = messages[-1] if messages else None
+        if self.semantic_cache is not None and isinstance(last, dict) and last.get("role") == "user" \
+                and isinstance(last.get("content"), str):
+            cached, cache_token = self.semantic_cache.lookup(
+                last["content"], messages[:-1], "openrouter", model, role, str(max_output_tokens),
+                build_facts_context(pre_extract_facts(messages)),
+            )
+            if cached is not None:
+                return cached
+
         # Prepend system message if not already present
         messages_with_system = [{"role": "system", "content": SYSTEM_PROMPT}] + messages
 
@@ -118,7 +168,12 @@ And then say: "Your resume is ready! You can edit any field in the form. Ask me
         }
 
         try:
-            completion = self.client.chat.completions.create(**request_kwargs)
+            with stage("upstream"):
+                raw = self.key_pool.call(
+                    lambda client: client.chat.completions.with_raw_response.create(**request_kwargs),
+                    quota_from=_header_quota,
+                )
+            completion = raw.parse()
         except Exception as e:
             logger.error(f"❌ OpenRouter API Error: {e}")
             return None, None
@@ -191,14 +246,54 @@ And then say: "Your resume is ready! You can edit any field in the form. Ask me
             except Exception:
                 pass
 
+        self._record_usage(completion, model, messages_with_system, assistant_text, session_id, role, endpoint)
+
         # 3) Clean assistant_text (remove json code blocks for UI)
         clean_text = assistant_text or ""
         if clean_text:
             clean_text = re.sub(r"```json[\s\S]*?```", "", clean_text).strip()
 
         logger.info(f"✅ OpenRouter response received. has_json={structured_json is not None}")
+        if self.semantic_cache is not None and (clean_text or structured_json is not None):
+            self.semantic_cache.store(cache_token, (clean_text, structured_json))
         return clean_text, structured_json
 
+    def _record_usage(self, completion, model, messages, assistant_text, session_id, role, endpoint):
+        """Report completion.usage to the ledger; estimate from message text when the router omits it."""
+        if self.usage_ledger is None:
+            return
+        usage = getattr(completion, "usage", None)
+        if usage is None or getattr(usage, "prompt_tokens", None) is None:
+            prompt_text = "".join(str(m.get("content", "")) for m in messages)
+            self.usage_ledger.record(
+                session_id=session_id, role=role, model=model, endpoint=endpoint,
+                prompt_tokens=estimate_tokens(prompt_text),
+                completion_tokens=estimate_tokens(assistant_text or ""),
+                estimated=True,
+            )
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.usage_ledger.record(
+            session_id=session_id, role=role, model=model, endpoint=endpoint,
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+            cached_tokens=(getattr(details, "cached_tokens", 0) or 0) if details else 0,
+        )
+
+    def key_metrics(self):
+        """Per-key quota and error counters (keys masked)."""
+        return self.key_pool.metrics()
+
+    def warm_up(self):
+        """Open each key's HTTP connection pool (GET /models, no tokens used) before the first user request."""
+        for slot in self.key_pool.slots:
+            try:
+                slot.client.models.list()
+            except Exception as e:
+                logger.warning(f"⚠️ OpenRouter warm-up failed for key {slot.masked}: {e}")
+        if self.key_pool.slots:
+            logger.info(f"🔥 OpenRouter clients warmed up ({len(self.key_pool)} key(s))")
+
 
 if __name__ == "__main__":
     # Example usage
@@ -0,0 +1,328 @@
+"""
+Append-only persistence for conversation turns and resume snapshots.
+
+The request path never touches the database: handlers call
+PersistenceWriter.enqueue_turn()/enqueue_resume(), and a background task
+writes queued records in batches (PERSIST_BATCH_SIZE records or every
+PERSIST_FLUSH_INTERVAL seconds, whichever comes first). A closed tab can then
+resume its session with load_session() instead of replaying it through the LLM.
+
+A handler whose turn a later request may read back (any worker can serve
+that one) awaits commit() before responding: the background task then writes
+what is queued right away, so turns of concurrent requests share one
+transaction (group commit), and load_session() only has to read the database.
+
+Session ids are issued by the server (SessionIds.new(), POST /api/sessions):
+a random part plus an HMAC of it, so they can't be guessed, and ids a client
+made up are rejected before anything is stored or read under them. The HMAC
+key is SESSION_SECRET, or a random secret kept in the database so every
+worker and restart shares it.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chatfolio.db")
+PERSIST_DB_PATH = os.getenv("PERSIST_DB_PATH", DEFAULT_DB_PATH)
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "0.5"))
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "200"))
+PERSIST_QUEUE_SIZE = int(os.getenv("PERSIST_QUEUE_SIZE", "10000"))
+SESSION_SECRET = os.getenv("SESSION_SECRET", "")
+
+# Queue records: ("turn", session_id, role, content, ts) / ("resume", session_id, data, version, ts)
+Record = Tuple[Any, ...]
+
+
+class ConversationStore:
+    """Storage interface used by PersistenceWriter."""
+
+    def write_batch(self, records: List[Record]):
+        raise NotImplementedError
+
+    def load_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def load_resume(self, session_id: str, version: Optional[int] = None) -> Optional[Tuple[int, Any]]:
+        """(version, data) of a session's resume snapshot (the latest without a version); None if missing."""
+        raise NotImplementedError
+
+    def session_secret(self) -> bytes:
+        """HMAC key for SessionIds, the same for every process using this store."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteConversationStore(ConversationStore):
+    """Default store: two append-only tables in one SQLite file (WAL mode)."""
+
+    def __init__(self, path: str = PERSIST_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS turns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS turns_session ON turns(session_id, id);
+            CREATE TABLE IF NOT EXISTS resume_snapshots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS resume_session_version ON resume_snapshots(session_id, version);
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            """
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10.0, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def write_batch(self, records):
+        conn = self._conn()
+        with conn:  # one transaction per batch
+            for record in records:
+                if record[0] == "turn":
+                    _, session_id, role, content, ts = record
+                    conn.execute(
+                        "INSERT INTO turns(session_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                        (session_id, role, content, ts),
+                    )
+                elif record[0] == "resume":
+                    _, session_id, data, version, ts = record
+                    if version is None:
+                        conn.execute(
+                            "INSERT INTO resume_snapshots(session_id, version, data, created_at)"
+                            " SELECT ?, COALESCE(MAX(version), 0) + 1, ?, ? FROM resume_snapshots WHERE session_id = ?",
+                            (session_id, json.dumps(data), ts, session_id),
+                        )
+                    else:
+                        # Version allocated atomically by resume_delta.ResumeVersions, so it is unique per session
+                        conn.execute(
+                            "INSERT OR IGNORE INTO resume_snapshots(session_id, version, data, created_at)"
+                            " VALUES (?, ?, ?, ?)",
+                            (session_id, version, json.dumps(data), ts),
+                        )
+
+    def load_session(self, session_id):
+        conn = self._conn()
+        turns = conn.execute(
+            "SELECT role, content FROM turns WHERE session_id = ? ORDER BY id", (session_id,)
+        ).fetchall()
+        snapshot = conn.execute(
+            "SELECT version, data FROM resume_snapshots WHERE session_id = ? ORDER BY version DESC LIMIT 1",
+            (session_id,),
+        ).fetchone()
+        if not turns and snapshot is None:
+            return None
+        return {
+            "sessionId": session_id,
+            "conversationHistory": [{"role": role, "content": content} for role, content in turns],
+            "resumeData": json.loads(snapshot[1]) if snapshot else None,
+            "resumeVersion": snapshot[0] if snapshot else 0,
+        }
+
+    def load_resume(self, session_id, version=None):
+        if version is None:
+            row = self._conn().execute(
+                "SELECT version, data FROM resume_snapshots WHERE session_id = ? ORDER BY version DESC LIMIT 1",
+                (session_id,),
+            ).fetchone()
+        else:
+            row = self._conn().execute(
+                "SELECT version, data FROM resume_snapshots WHERE session_id = ? AND version = ?",
+                (session_id, version),
+            ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def session_secret(self):
+        conn = self._conn()
+        with conn:
+            # First process to get here picks the secret; the rest read it
+            conn.execute(
+                "INSERT OR IGNORE INTO settings(key, value) VALUES ('session_secret', ?)", (secrets.token_hex(32),)
+            )
+        row = conn.execute("SELECT value FROM settings WHERE key = 'session_secret'").fetchone()
+        return bytes.fromhex(row[0])
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class SessionIds:
+    """Issues and checks session ids of the form <random>.<hmac(random)>."""
+
+    def __init__(self, secret: bytes):
+        self.secret = secret
+
+    def _sign(self, nonce: str) -> str:
+        return hmac.new(self.secret, nonce.encode(), hashlib.sha256).hexdigest()[:32]
+
+    def new(self) -> str:
+        nonce = secrets.token_urlsafe(18)
+        return f"{nonce}.{self._sign(nonce)}"
+
+    def valid(self, session_id: Any) -> bool:
+        """True only for ids issued by new() with the same secret."""
+        if not isinstance(session_id, str):
+            return False
+        nonce, _, signature = session_id.partition(".")
+        return bool(nonce) and hmac.compare_digest(signature, self._sign(nonce))
+
+
+class PersistenceWriter:
+    """Batches queued records and writes them to the store off the event loop."""
+
+    def __init__(self, store: ConversationStore, flush_interval: float = PERSIST_FLUSH_INTERVAL,
+                 batch_size: int = PERSIST_BATCH_SIZE, queue_size: int = PERSIST_QUEUE_SIZE):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # Records enqueued / handled by the writer so far, and commit() waiters as (enqueued, future)
+        self._enqueued = 0
+        self._handled = 0
+        self._waiters: List[Tuple[int, asyncio.Future]] = []
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._not_empty = asyncio.Event()
+        self._batch_ready = asyncio.Event()
+        self._write_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"✅ Persistence writer started (batch={self.batch_size}, interval={self.flush_interval}s)")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # Write what is queued (waiting for any in-flight batch) before stopping the loop
+        await self.flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def _enqueue(self, record: Record):
+        if self._queue is None:
+            # Writer not started (e.g. imported outside the app) - nothing to do
+            return
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"⚠️ Persistence queue full - dropped {record[0]} for session {record[1]}")
+            return
+        self._enqueued += 1
+        self._not_empty.set()
+        if self._queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+
+    def enqueue_turn(self, session_id: str, role: str, content: str):
+        self._enqueue(("turn", session_id, role, content, time.time()))
+
+    def enqueue_resume(self, session_id: str, data: Dict[str, Any], version: Optional[int] = None):
+        """Queue a resume snapshot; without a version it becomes the session's latest + 1."""
+        self._enqueue(("resume", session_id, data, version, time.time()))
+
+    async def commit(self):
+        """Wait until everything enqueued so far has been written (or has failed, which is logged)."""
+        if self._queue is None or self._handled >= self._enqueued:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append((self._enqueued, waiter))
+        self._batch_ready.set()
+        await waiter
+
+    def _release_waiters(self):
+        pending = []
+        for target, waiter in self._waiters:
+            if target <= self._handled:
+                if not waiter.done():
+                    waiter.set_result(None)
+            else:
+                pending.append((target, waiter))
+        self._waiters = pending
+
+    async def _run(self):
+        while True:
+            await self._not_empty.wait()
+            if self._queue.qsize() < self.batch_size and not self._waiters:
+                # Let the batch fill up, but never hold records longer than flush_interval
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            await self.flush()
+
+    async def flush(self):
+        """Write everything queued so far, in order; returns once earlier in-flight batches are written too."""
+        if self._queue is None:
+            return
+        async with self._write_lock:
+            while not self._queue.empty():
+                batch: List[Record] = []
+                while len(batch) < self.batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                try:
+                    await asyncio.to_thread(self.store.write_batch, batch)
+                    self.written += len(batch)
+                except Exception as e:
+                    self.failed += len(batch)
+                    logger.error(f"❌ Persistence batch of {len(batch)} records failed: {e}")
+                self._handled += len(batch)
+                self._release_waiters()
+            self._not_empty.clear()
+            self._batch_ready.clear()
+
+    async def load_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Load a stored session; turns are there once the request that added them has commit()ed."""
+        return await asyncio.to_thread(self.store.load_session, session_id)
+
+    async def load_resume(self, session_id: str, version: Optional[int] = None) -> Optional[Tuple[int, Any]]:
+        """(version, data) of a committed resume snapshot, see ConversationStore.load_resume."""
+        return await asyncio.to_thread(self.store.load_resume, session_id, version)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
@@ -0,0 +1,247 @@
+"""
+Opt-in per-request profiling.
+
+A request is profiled when it carries `X-Profile: <PROFILE_TOKEN>` or is
+picked by PROFILE_SAMPLE_RATE. For those requests ProfilingMiddleware writes
+to PROFILE_DIR:
+
+    <id>.folded  collapsed stacks (flamegraph.pl, speedscope, inferno)  [sampling mode]
+    <id>.pstats  cProfile stats (snakeviz, gprof2dot)                  [deterministic mode]
+    <id>.json    request info + per-stage timings from stage() blocks
+
+Only the newest PROFILE_KEEP profiles are kept. When a request is not
+profiled the middleware adds one header lookup, and stage() returns a shared
+no-op context manager.
+
+The sampler covers the event loop thread plus every thread the request's
+work runs on: threads entered through profiling.to_thread() or a stage()
+block are registered for the duration of that call, and their stacks are
+rooted at a `thread:<name>` frame. The deterministic profiler only sees the
+event loop thread, and only one request per process can hold it (cProfile
+hooks are per thread); requests profiled while it is busy are sampled
+instead and marked "mode": "sampling" in their .json.
+
+Note: the event loop is shared, so stacks from other requests running
+concurrently on the same worker show up too.
+"""
+import asyncio
+import contextlib
+import contextvars
+import cProfile
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Callable, List, Optional, Set, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sampling")  # "sampling" or "deterministic"
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+
+PROFILE_HEADER = b"x-profile"
+
+# Stage timings of the request being profiled; None when profiling is off
+_stages: contextvars.ContextVar[Optional[List[Tuple[str, float, float]]]] = contextvars.ContextVar(
+    "profile_stages", default=None
+)
+# Threads the request being profiled runs on (shared with the sampler); None when off
+_threads: contextvars.ContextVar[Optional[Set[int]]] = contextvars.ContextVar("profile_threads", default=None)
+_NOOP = contextlib.nullcontext()
+# Held by the one request being profiled deterministically
+_deterministic_lock = threading.Lock()
+
+T = TypeVar("T")
+
+
+@contextlib.contextmanager
+def _on_thread(threads: Set[int]):
+    """Register the current thread with the sampler for the duration of the block."""
+    ident = threading.get_ident()
+    added = ident not in threads
+    threads.add(ident)
+    try:
+        yield
+    finally:
+        if added:
+            threads.discard(ident)
+
+
+@contextlib.contextmanager
+def _timed_stage(name: str, stages, threads):
+    start = time.perf_counter()
+    try:
+        with _on_thread(threads):
+            yield
+    finally:
+        stages.append((name, start, time.perf_counter()))
+
+
+def stage(name: str):
+    """Time a block under `name` when the current request is being profiled."""
+    stages = _stages.get()
+    if stages is None:
+        return _NOOP
+    return _timed_stage(name, stages, _threads.get())
+
+
+def _call_on_thread(threads: Set[int], func, args, kwargs):
+    with _on_thread(threads):
+        return func(*args, **kwargs)
+
+
+async def to_thread(func: Callable[..., T], *args, **kwargs) -> T:
+    """asyncio.to_thread() whose worker thread is sampled when the request is being profiled."""
+    threads = _threads.get()
+    if threads is None:
+        return await asyncio.to_thread(func, *args, **kwargs)
+    return await asyncio.to_thread(_call_on_thread, threads, func, args, kwargs)
+
+
+class _StackSampler(threading.Thread):
+    """Samples the stacks of a (changing) set of threads every `interval` seconds into collapsed-stack counts."""
+
+    def __init__(self, thread_ids: Set[int], interval: float):
+        super().__init__(daemon=True)
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self.counts: Counter = Counter()
+        self._names = {}
+        self._stop_event = threading.Event()
+
+    def _thread_name(self, thread_id: int) -> str:
+        name = self._names.get(thread_id)
+        if name is None:
+            self._names = {t.ident: t.name for t in threading.enumerate()}
+            name = self._names.get(thread_id, str(thread_id))
+        return name
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in list(self.thread_ids):
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if stack:
+                    stack.append(f"thread:{self._thread_name(thread_id)}")
+                    self.counts[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _prune(directory: str, keep: int):
+    """Delete all but the newest `keep` profiles (files of one profile share an id prefix)."""
+    mtimes = {}
+    for name in os.listdir(directory):
+        profile_id = name.split(".", 1)[0]
+        mtime = os.path.getmtime(os.path.join(directory, name))
+        mtimes[profile_id] = max(mtime, mtimes.get(profile_id, 0))
+    ids = sorted(mtimes, key=mtimes.get)
+    for old in ids[:-keep] if keep > 0 else ids:
+        for ext in (".folded", ".pstats", ".json"):
+            path = os.path.join(directory, old + ext)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _write_profile(profile_id: str, info: dict, sampler: Optional[_StackSampler], profiler: Optional[cProfile.Profile]):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, profile_id)
+    if sampler is not None:
+        with open(base + ".folded", "w") as f:
+            for stack, count in sampler.counts.most_common():
+                f.write(f"{stack} {count}\n")
+    if profiler is not None:
+        profiler.dump_stats(base + ".pstats")
+    with open(base + ".json", "w") as f:
+        json.dump(info, f, indent=2)
+    _prune(PROFILE_DIR, PROFILE_KEEP)
+
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling requests selected by header token or sample rate."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def _selected(self, scope) -> bool:
+        if PROFILE_TOKEN:
+            for key, value in scope["headers"]:
+                if key == PROFILE_HEADER:
+                    return value.decode("latin-1") == PROFILE_TOKEN
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._selected(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        status = {"code": None}
+
+        async def wrapped_send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message.setdefault("headers", []).append((b"x-profile-id", profile_id.encode()))
+            await send(message)
+
+        stages: List[Tuple[str, float, float]] = []
+        threads = {threading.get_ident()}
+        token = _stages.set(stages)
+        threads_token = _threads.set(threads)
+        sampler = profiler = None
+        if PROFILE_MODE == "deterministic" and _deterministic_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiling tool owns the hook (3.12+ refuses a second one)
+                profiler = None
+                _deterministic_lock.release()
+        if profiler is None:
+            sampler = _StackSampler(threads, PROFILE_INTERVAL)
+            sampler.start()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, wrapped_send)
+        finally:
+            total = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                _deterministic_lock.release()
+            if sampler is not None:
+                sampler.stop()
+            _stages.reset(token)
+            _threads.reset(threads_token)
+            info = {
+                "id": profile_id,
+                "method": scope.get("method"),
+                "path": scope.get("path"),
+                "status": status["code"],
+                "mode": "deterministic" if profiler is not None else "sampling",
+                "total_ms": round(total * 1000, 3),
+                "stages": [
+                    {"stage": name, "start_ms": round((s - start) * 1000, 3), "duration_ms": round((e - s) * 1000, 3)}
+                    for name, s, e in stages
+                ],
+            }
+            try:
+                await asyncio.to_thread(_write_profile, profile_id, info, sampler, profiler)
+                logger.info(f"📊 Profile {profile_id} written ({info['total_ms']} ms)")
+            except Exception as e:
+                logger.error(f"❌ Failed to write profile {profile_id}: {e}")
@@ -0,0 +1,210 @@
+"""
+Delta-encoded resumeData.
+
+Instead of resending the whole resume document every turn, a client can ask
+for only the changes against a base version it already holds:
+
+    responseMode: "full" (default) | "json-patch" (RFC 6902) | "merge-patch" (RFC 7386)
+    baseVersion:  version number from a previous response (session-held base)
+    baseResume:   the base document itself (client-supplied base)
+
+Versions of a session are allocated with the shared store's atomic incr()
+on "resume:<sessionId>:version", so concurrent turns (HTTP and /ws/chat, or
+a double submit) never get the same number. Each document is held under
+"resume:<sessionId>:v<N>" for RESUME_DELTA_TTL, so any worker can diff
+against the exact version a client names, and is persisted through the
+PersistenceWriter under the same number; an expired one is read back from
+the persisted snapshot. A session whose counter is missing from the store
+(e.g. the store was reset) is seeded past its latest persisted snapshot.
+So the resumeVersion of /api/chat, /api/openrouter, /ws/chat?session= and
+GET /api/sessions/{id} always names the same document. When no usable base exists the full document is returned, so clients
+always get either a patch against a version they hold or a full copy.
+"""
+import asyncio
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+RESUME_DELTA_TTL = float(os.getenv("RESUME_DELTA_TTL", str(24 * 3600)))
+
+
+def _pointer(path: str, token) -> str:
+    token = str(token).replace("~", "~0").replace("/", "~1")
+    return f"{path}/{token}"
+
+
+def _same(a: Any, b: Any) -> bool:
+    """JSON equality: unlike ==, 1, 1.0 and true are different values."""
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_same(a[k], b[k]) for k in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(_same(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def make_json_patch(old: Any, new: Any, path: str = "") -> List[Dict[str, Any]]:
+    """RFC 6902 operations turning `old` into `new`."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": _pointer(path, key)})
+        for key, value in new.items():
+            if key not in old:
+                ops.append({"op": "add", "path": _pointer(path, key), "value": value})
+            else:
+                ops.extend(make_json_patch(old[key], value, _pointer(path, key)))
+        return ops
+    if isinstance(old, list) and isinstance(new, list):
+        ops = []
+        common = min(len(old), len(new))
+        for i in range(common):
+            ops.extend(make_json_patch(old[i], new[i], _pointer(path, i)))
+        # Remove from the end first so earlier indexes stay valid
+        for i in range(len(old) - 1, common - 1, -1):
+            ops.append({"op": "remove", "path": _pointer(path, i)})
+        for i in range(common, len(new)):
+            ops.append({"op": "add", "path": _pointer(path, "-"), "value": new[i]})
+        return ops
+    if _same(old, new):
+        return []
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+def make_merge_patch(old: Any, new: Any) -> Any:
+    """
+    RFC 7386 merge patch turning `old` into `new`.
+    Note: merge patches cannot set a member to null (null means remove).
+    """
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return new
+    patch = {}
+    for key in old:
+        if key not in new:
+            patch[key] = None
+    for key, value in new.items():
+        if key not in old:
+            patch[key] = value
+        elif isinstance(old[key], dict) and isinstance(value, dict):
+            sub = make_merge_patch(old[key], value)
+            if sub:
+                patch[key] = sub
+        elif not _same(old[key], value):
+            patch[key] = value
+    return patch
+
+
+def apply_merge_patch(target: Any, patch: Any) -> Any:
+    """RFC 7386 MergePatch(target, patch); returns a new value."""
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = apply_merge_patch(result.get(key), value)
+    return result
+
+
+def patch_fields(mode: str, base: Any, new: Any) -> Dict[str, Any]:
+    """resumeData response fields for `new`: a patch against `base` when possible, else the full document."""
+    if mode not in ("json-patch", "merge-patch") or base is None or new is None:
+        return {"resumeData": new}
+    if mode == "json-patch":
+        patch = make_json_patch(base, new)
+    else:
+        patch = make_merge_patch(base, new)
+        if not _same(apply_merge_patch(base, patch), new):
+            # A merge patch can't set a member to null (null means remove) - send the document instead
+            return {"resumeData": new}
+    return {"resumeData": None, "resumePatch": patch, "patchFormat": mode}
+
+
+class ResumeVersions:
+    """Resume document versions per session, allocated and held in the shared state store."""
+
+    def __init__(self, store, writer=None, ttl: float = RESUME_DELTA_TTL):
+        """
+        Args:
+            store: shared_state.SharedStore holding version counters and recent documents
+            writer: optional persistence.PersistenceWriter that persists versions and backs expired ones
+            ttl: seconds a document is held in the store
+        """
+        self.store = store
+        self.writer = writer
+        self.ttl = ttl
+
+    def _counter_key(self, session_id: str) -> str:
+        return f"resume:{session_id}:version"
+
+    def _doc_key(self, session_id: str, version: int) -> str:
+        return f"resume:{session_id}:v{version}"
+
+    def _next_version(self, session_id: str) -> int:
+        """Atomically allocate the session's next version (runs in a thread)."""
+        key = self._counter_key(session_id)
+        if self.writer is not None and self.store.get(key) is None:
+            latest = self.writer.store.load_resume(session_id)
+            if latest:
+                # Racing seeders each add `latest`: versions may skip numbers, but stay unique and increasing
+                self.store.incr(key, latest[0])
+        # No TTL: the counter must outlive its documents or numbers would be reused
+        return self.store.incr(key)
+
+    async def _document(self, session_id: str, version: int) -> Optional[Any]:
+        try:
+            held = await asyncio.to_thread(self.store.get, self._doc_key(session_id, version))
+        except Exception as e:
+            logger.warning(f"⚠️ Resume version store unavailable: {e}")
+            held = None
+        if held is None and self.writer is not None:
+            stored = await self.writer.load_resume(session_id, version)
+            return stored[1] if stored else None
+        return held
+
+    async def encode(self, resume_data: Any, session_id: Optional[str] = None,
+                     mode: str = "full", base_version: Optional[int] = None,
+                     base_resume: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Response fields for resumeData in the requested mode.
+
+        With a session_id, a new resume_data becomes the session's next
+        version (persisted through the writer).
+
+        Returns a dict with "resumeData" (full document or None), and when
+        applicable "resumeVersion", "resumePatch" and "patchFormat".
+        """
+        base = base_resume
+        if base is None and session_id and base_version is not None and mode in ("json-patch", "merge-patch"):
+            base = await self._document(session_id, base_version)
+
+        version = None
+        if session_id and resume_data is not None:
+            try:
+                version = await asyncio.to_thread(self._next_version, session_id)
+            except Exception as e:
+                # Without a unique version the document can't be offered as a base later
+                logger.warning(f"⚠️ Could not allocate resume version: {e}")
+            if version is not None:
+                if self.writer is not None:
+                    self.writer.enqueue_resume(session_id, resume_data, version)
+                try:
+                    await asyncio.to_thread(
+                        self.store.set, self._doc_key(session_id, version), resume_data, ttl=self.ttl
+                    )
+                except Exception as e:
+                    logger.warning(f"⚠️ Could not store resume version: {e}")
+        elif session_id:
+            latest = await self.writer.load_resume(session_id) if self.writer is not None else None
+            version = latest[0] if latest else 0
+
+        # No base the client is known to hold -> full document
+        fields = patch_fields(mode, base, resume_data)
+        if version is not None:
+            fields["resumeVersion"] = version
+        return fields
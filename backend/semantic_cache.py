@@ -0,0 +1,289 @@
+"""
+Near-duplicate response cache for short, low-context turns.
+
+Openers like "hi there", "Hi!" and "hello, create my resume" differ only in
+casing, punctuation or filler, so exact-match caching misses them. Both
+clients look up SemanticCache before calling upstream:
+
+- only turns with at most SEMANTIC_CACHE_MAX_HISTORY prior messages and a
+  user message of at most SEMANTIC_CACHE_MAX_CHARS characters are eligible
+- messages carrying personal data are never cached or served: anything
+  fact_extractor finds a fact in (name, email, phone, ...), or with an email,
+  phone number or capitalized name-like word
+- the message is normalized (case, punctuation, filler words, greeting
+  synonyms), shingled into words + character 3-grams and MinHashed
+- an LSH index (bands x rows of the signature) finds candidates; each one
+  is verified with the exact Jaccard similarity of the shingle sets against
+  SEMANTIC_CACHE_THRESHOLD, and the significant tokens of both messages
+  (numbers and negations: "not", "no", "never", "n't") must match exactly
+- entries are partitioned by a scope hash of provider, model, role, facts
+  context and the normalized prior messages, so a different facts context
+  never hits
+- LRU eviction at SEMANTIC_CACHE_SIZE entries, SEMANTIC_CACHE_TTL expiry
+
+Off by default; enable with SEMANTIC_CACHE_ENABLED=1. The index and entries
+are per process (not in the shared_state store): each worker warms its own
+cache, which costs extra misses but never a wrong answer.
+
+metrics() reports hit rate, LSH candidates rejected by verification, and
+false positives reported through report_false_positive() (which drops the entry).
+Responses served from the cache are recorded in the hit-tracking dict
+installed by track_hits(), so endpoints can expose the entry id.
+"""
+import contextvars
+import copy
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from fact_extractor import EMAIL_RE, PHONE_RE, pre_extract_facts
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "0") == "1"
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "2000"))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.85"))
+SEMANTIC_CACHE_MAX_CHARS = int(os.getenv("SEMANTIC_CACHE_MAX_CHARS", "120"))
+SEMANTIC_CACHE_MAX_HISTORY = int(os.getenv("SEMANTIC_CACHE_MAX_HISTORY", "2"))
+
+# 8 bands x 4 rows: pairs at Jaccard 0.75 become candidates ~95% of the time, at 0.3 ~6%
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+_PRIME = (1 << 61) - 1
+_MASK = (1 << 64) - 1
+
+# Fixed (a, b) pairs so signatures are stable across processes
+_PERMUTATIONS = [
+    (int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") | 1,
+     int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big"))
+    for i in range(NUM_PERM)
+]
+
+FILLER_WORDS = frozenset({
+    "um", "uh", "erm", "hmm", "please", "pls", "plz", "just", "so", "well", "ok", "okay",
+    "there", "again", "can", "could", "you", "would", "like", "to", "i", "want", "me", "my", "a", "the",
+})
+GREETINGS = {"hello": "hi", "hey": "hi", "hiya": "hi", "howdy": "hi", "yo": "hi", "greetings": "hi",
+             "heya": "hi", "hii": "hi", "hiii": "hi"}
+
+# Tokens that flip or pin the meaning, so they must be identical for a hit
+NEGATIONS = frozenset({"not", "no", "never", "nor", "none", "nothing", "neither", "without"})
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_NUMBER_RE = re.compile(r"\d+")
+_CONTRACTION_RE = re.compile(r"n['’]t\b")
+# A capitalized word after the first one ("hey John", "at Acme") - likely a name
+_PROPER_NOUN_RE = re.compile(r"(?<=\s)(?!I\b)[A-Z][a-z]+")
+
+# Hit details of the current request (a dict shared with worker threads); None when not tracked
+_hits: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("semantic_cache_hits", default=None)
+
+
+def track_hits() -> Dict[str, Any]:
+    """Start recording cache hits for the current request; returns the dict that gets filled in."""
+    hits: Dict[str, Any] = {}
+    _hits.set(hits)
+    return hits
+
+
+def has_personal_data(message: str) -> bool:
+    """True when the message carries anything user-specific that must not be shared via the cache."""
+    if pre_extract_facts([{"role": "user", "content": message}]):
+        return True
+    return bool(EMAIL_RE.search(message) or PHONE_RE.search(message) or _PROPER_NOUN_RE.search(message))
+
+
+def normalize(text: str) -> str:
+    text = _CONTRACTION_RE.sub(" not", text.lower()).replace("cannot", "can not")
+    words = [GREETINGS.get(w, w) for w in _WORD_RE.findall(text)]
+    kept = [w for w in words if w not in FILLER_WORDS]
+    # A message made only of filler ("ok", "please") keeps its words
+    return " ".join(kept or words)
+
+
+def shingles(normalized: str) -> FrozenSet[str]:
+    words = normalized.split()
+    grams = {f"w:{w}" for w in words}
+    padded = f" {normalized} "
+    grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(grams)
+
+
+def minhash(features: FrozenSet[str]) -> Tuple[int, ...]:
+    hashes = [int.from_bytes(hashlib.blake2b(f.encode(), digest_size=8).digest(), "big") for f in features]
+    if not hashes:
+        return (0,) * NUM_PERM
+    return tuple(min(((a * h + b) & _MASK) % _PRIME for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def significant_tokens(normalized: str) -> FrozenSet[str]:
+    words = normalized.split()
+    return frozenset(w for w in words if w in NEGATIONS or _NUMBER_RE.fullmatch(w))
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class _Entry:
+    __slots__ = ("id", "scope", "features", "significant", "bands", "value", "created_at", "hits")
+
+    def __init__(self, scope, features, significant, bands, value):
+        self.id = uuid.uuid4().hex[:16]
+        self.scope = scope
+        self.features = features
+        self.significant = significant
+        self.bands = bands
+        self.value = value
+        self.created_at = time.monotonic()
+        self.hits = 0
+
+
+class CacheToken:
+    """Result of an eligible lookup miss; pass to store() once the upstream answer is in."""
+    __slots__ = ("scope", "features", "significant", "bands")
+
+    def __init__(self, scope, features, significant, bands):
+        self.scope = scope
+        self.features = features
+        self.significant = significant
+        self.bands = bands
+
+
+class SemanticCache:
+    """Thread-safe (clients run in worker threads) LRU of near-duplicate responses."""
+
+    def __init__(self, max_entries: int = SEMANTIC_CACHE_SIZE, ttl: float = SEMANTIC_CACHE_TTL,
+                 threshold: float = SEMANTIC_CACHE_THRESHOLD, max_chars: int = SEMANTIC_CACHE_MAX_CHARS,
+                 max_history: int = SEMANTIC_CACHE_MAX_HISTORY):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.max_chars = max_chars
+        self.max_history = max_history
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._buckets: Dict[tuple, set] = {}
+        self._lock = threading.Lock()
+        self.counters = {
+            "lookups": 0, "ineligible": 0, "hits": 0, "misses": 0, "stores": 0,
+            "candidates_checked": 0, "lsh_false_positives": 0, "reported_false_positives": 0,
+            "evictions": 0, "expired": 0,
+        }
+
+    @staticmethod
+    def scope_key(*parts: str, history: List[Any] = ()) -> str:
+        """Partition hash: provider/model/role/facts context plus the normalized prior messages."""
+        prior = "\x1e".join(f"{m.get('role', '')}:{normalize(str(m.get('content', '')))}" for m in history)
+        return hashlib.sha256("\x1f".join([*parts, prior]).encode("utf-8")).hexdigest()
+
+    def _unlink(self, entry: _Entry):
+        for band in entry.bands:
+            bucket = self._buckets.get(band)
+            if bucket is not None:
+                bucket.discard(entry.id)
+                if not bucket:
+                    del self._buckets[band]
+
+    def _remove(self, entry_id: str):
+        entry = self._entries.pop(entry_id, None)
+        if entry is not None:
+            self._unlink(entry)
+
+    def lookup(self, message: str, history: List[Any], *scope_parts: str) -> Tuple[Any, Optional[CacheToken]]:
+        """
+        Returns (cached_value, None) on a hit, (None, token) on an eligible miss,
+        and (None, None) when the turn is not eligible for caching.
+        """
+        eligible = len(history) <= self.max_history and len(message) <= self.max_chars
+        normalized = normalize(message) if eligible and not has_personal_data(message) else ""
+        if not normalized:
+            with self._lock:
+                self.counters["lookups"] += 1
+                self.counters["ineligible"] += 1
+            return None, None
+        scope = self.scope_key(*scope_parts, history=history)
+        features = shingles(normalized)
+        significant = significant_tokens(normalized)
+        signature = minhash(features)
+        bands = tuple((scope, i, signature[i * ROWS:(i + 1) * ROWS]) for i in range(BANDS))
+
+        now = time.monotonic()
+        with self._lock:
+            self.counters["lookups"] += 1
+            candidate_ids = set()
+            for band in bands:
+                candidate_ids.update(self._buckets.get(band, ()))
+            best, best_score = None, 0.0
+            for entry_id in candidate_ids:
+                entry = self._entries.get(entry_id)
+                if entry is None:
+                    continue
+                if now - entry.created_at > self.ttl:
+                    self._remove(entry_id)
+                    self.counters["expired"] += 1
+                    continue
+                self.counters["candidates_checked"] += 1
+                score = jaccard(features, entry.features)
+                if score < self.threshold or entry.significant != significant:
+                    self.counters["lsh_false_positives"] += 1
+                    continue
+                if score > best_score:
+                    best, best_score = entry, score
+            if best is not None:
+                self._entries.move_to_end(best.id)
+                best.hits += 1
+                self.counters["hits"] += 1
+                hits = _hits.get()
+                if hits is not None:
+                    hits.update(entry=best.id, similarity=round(best_score, 3))
+                logger.info(f"🎯 Semantic cache hit {best.id} (similarity={best_score:.2f})")
+                # Callers get their own copy of the cached (text, resume JSON)
+                return copy.deepcopy(best.value), None
+            self.counters["misses"] += 1
+        return None, CacheToken(scope, features, significant, bands)
+
+    def store(self, token: Optional[CacheToken], value: Any):
+        if token is None:
+            return
+        entry = _Entry(token.scope, token.features, token.significant, token.bands, value)
+        with self._lock:
+            self._entries[entry.id] = entry
+            for band in entry.bands:
+                self._buckets.setdefault(band, set()).add(entry.id)
+            self.counters["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._unlink(evicted)
+                self.counters["evictions"] += 1
+
+    def report_false_positive(self, entry_id: str) -> bool:
+        """A served cache entry was wrong for the message: count it and drop the entry."""
+        with self._lock:
+            if entry_id not in self._entries:
+                return False
+            self._remove(entry_id)
+            self.counters["reported_false_positives"] += 1
+        logger.warning(f"⚠️ Semantic cache entry {entry_id} reported as a false positive - dropped")
+        return True
+
+    def metrics(self) -> Dict[str, Any]:
+        eligible = self.counters["hits"] + self.counters["misses"]
+        checked = self.counters["candidates_checked"]
+        hits = self.counters["hits"]
+        return {
+            **self.counters,
+            "entries": len(self._entries),
+            "hit_rate": round(hits / eligible, 4) if eligible else None,
+            "lsh_false_positive_rate": round(self.counters["lsh_false_positives"] / checked, 4) if checked else None,
+            "reported_false_positive_rate": round(self.counters["reported_false_positives"] / hits, 4) if hits else None,
+        }
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Production entry point for the backend.
+Run: python -m backend (from the repo root) or python server.py [--workers N] [--port 8000]
+
+- uses uvloop and httptools when installed (pip install uvloop httptools),
+  asyncio and h11 otherwise
+- SERVER_WORKERS defaults to the number of CPUs this process may run on
+- keep-alive, listen backlog, concurrency limit and graceful shutdown come
+  from SERVER_* environment variables (or the matching flags)
+- uvicorn's own loggers go through log_config's JSON queue logging
+
+Note: per-process state (WebSocket connections, job queues, the semantic
+cache, key pool counters without a shared store) is per worker; see
+"Multi-worker Shared State" in API_GUIDE.md.
+"""
+import argparse
+import importlib.util
+import logging
+import os
+
+import uvicorn
+from dotenv import load_dotenv
+
+from log_config import setup_logging
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+load_dotenv(os.path.join(BACKEND_DIR, ".env"))
+
+logger = logging.getLogger(__name__)
+
+
+def cpu_count() -> int:
+    """CPUs available to this process (respects taskset/cpuset affinity)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _optional_int(value: str):
+    return int(value) if value else None
+
+
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", os.getenv("PORT", "8000")))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", str(cpu_count())))
+SERVER_KEEPALIVE = int(os.getenv("SERVER_KEEPALIVE", "5"))
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", "2048"))
+SERVER_LIMIT_CONCURRENCY = _optional_int(os.getenv("SERVER_LIMIT_CONCURRENCY", ""))
+SERVER_LIMIT_MAX_REQUESTS = _optional_int(os.getenv("SERVER_LIMIT_MAX_REQUESTS", ""))
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", "30"))
+SERVER_ACCESS_LOG = os.getenv("SERVER_ACCESS_LOG", "1") == "1"
+SERVER_FORWARDED_ALLOW_IPS = os.getenv("SERVER_FORWARDED_ALLOW_IPS", "127.0.0.1")
+
+
+def pick_loop() -> str:
+    return "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+
+
+def pick_http() -> str:
+    return "httptools" if importlib.util.find_spec("httptools") else "h11"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the resume builder backend")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS)
+    parser.add_argument("--keepalive", type=int, default=SERVER_KEEPALIVE, help="Keep-alive timeout (s)")
+    parser.add_argument("--backlog", type=int, default=SERVER_BACKLOG, help="Listen backlog")
+    parser.add_argument("--limit-concurrency", type=int, default=SERVER_LIMIT_CONCURRENCY,
+                        help="Connections/tasks per worker before answering 503")
+    parser.add_argument("--limit-max-requests", type=int, default=SERVER_LIMIT_MAX_REQUESTS,
+                        help="Restart a worker after this many requests")
+    parser.add_argument("--graceful-timeout", type=int, default=SERVER_GRACEFUL_TIMEOUT)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging()
+    loop, http = pick_loop(), pick_http()
+    workers = max(1, args.workers)
+    logger.info(
+        f"🚀 Starting backend on {args.host}:{args.port} "
+        f"(workers={workers}, loop={loop}, http={http}, keepalive={args.keepalive}s, "
+        f"backlog={args.backlog}, limit_concurrency={args.limit_concurrency})"
+    )
+    uvicorn.run(
+        "main:app",
+        app_dir=BACKEND_DIR,
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        loop=loop,
+        http=http,
+        timeout_keep_alive=args.keepalive,
+        backlog=args.backlog,
+        limit_concurrency=args.limit_concurrency,
+        limit_max_requests=args.limit_max_requests,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        access_log=SERVER_ACCESS_LOG,
+        forwarded_allow_ips=SERVER_FORWARDED_ALLOW_IPS,
+        # Keep log_config.setup_logging()'s handlers; uvicorn loggers propagate to them
+        log_config=None,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""
+Shared state backend for caches, sessions and rate-limit counters.
+
+Under `uvicorn --workers N` every worker is its own process, so anything
+kept in a module-level dict fragments N ways. The stores here give all
+workers on one host the same view:
+
+    memory://                   in-process dict (single worker / tests)
+    sqlite:///path/to/state.db  SQLite in WAL mode with mmap reads (default)
+    redis://host:6379/0         Redis or any Redis-protocol server (needs `redis`)
+
+Pick one with SHARED_STATE_URL and get it through get_shared_store().
+Values are JSON-serializable; keys should carry a prefix such as
+"cache:", "session:" or "rate:" so the kinds don't collide.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SQLITE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shared_state.db")
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL", f"sqlite:///{DEFAULT_SQLITE_PATH}")
+
+
+class SharedStore:
+    """Interface implemented by every backend."""
+
+    def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """Atomically add `amount` and return the new value. `ttl` applies when the key is created."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryStore(SharedStore):
+    """Process-local store. Fastest, but not shared between workers."""
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[Any, Optional[float]]] = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key: str, now: float):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= now:
+            del self._data[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key, time.time())
+            return entry[0] if entry else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl if ttl else None)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key, amount=1, ttl=None):
+        with self._lock:
+            now = time.time()
+            entry = self._live(key, now)
+            if entry is None:
+                entry = (0, now + ttl if ttl else None)
+            value = int(entry[0]) + amount
+            self._data[key] = (value, entry[1])
+            return value
+
+
+class SQLiteStore(SharedStore):
+    """
+    SQLite-backed store shared by all processes on the host.
+
+    WAL mode lets readers run alongside one writer, and mmap keeps hot pages
+    in the page cache so a hit is a B-tree lookup without a read() syscall.
+    One connection per thread, since sqlite3 connections are not thread-safe.
+    """
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, path: str, mmap_size: int = 64 * 1024 * 1024):
+        self.path = path
+        self.mmap_size = mmap_size
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS kv_expires ON kv(expires_at)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time()),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        self._conn().execute(
+            "INSERT INTO kv(key, value, expires_at) VALUES (?, ?, ?)"
+            " ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+            (key, json.dumps(value), expires_at),
+        )
+        self._after_write()
+
+    def delete(self, key):
+        self._conn().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def incr(self, key, amount=1, ttl=None):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value, expires_at FROM kv WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                value, expires_at = amount, (now + ttl if ttl else None)
+            else:
+                value, expires_at = int(json.loads(row[0])) + amount, row[1]
+            conn.execute(
+                "INSERT OR REPLACE INTO kv(key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._after_write()
+        return value
+
+    def _after_write(self):
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self._conn().execute(
+                "DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),)
+            )
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class RedisStore(SharedStore):
+    """Store speaking the Redis protocol (Redis, Valkey, KeyDB, a local stand-in...)."""
+
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("redis package not installed - install with: pip install redis")
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        raw = self._redis.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(key, json.dumps(value), px=int(ttl * 1000) if ttl else None)
+
+    def delete(self, key):
+        self._redis.delete(key)
+
+    def incr(self, key, amount=1, ttl=None):
+        value = int(self._redis.incrby(key, amount))
+        if ttl and value == amount:
+            # Counter was just created - start its window
+            self._redis.pexpire(key, int(ttl * 1000))
+        return value
+
+    def close(self):
+        self._redis.close()
+
+
+def create_store(url: str) -> SharedStore:
+    """Build a store from a URL (memory://, sqlite:///path, redis://...)."""
+    if url.startswith("memory://"):
+        return MemoryStore()
+    if url.startswith("sqlite:///"):
+        return SQLiteStore(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStore(url)
+    raise ValueError(f"Unsupported SHARED_STATE_URL: {url}")
+
+
+_store: Optional[SharedStore] = None
+
+
+def get_shared_store() -> SharedStore:
+    """Process-wide store built from SHARED_STATE_URL; falls back to memory if it can't be opened."""
+    global _store
+    if _store is None:
+        try:
+            _store = create_store(SHARED_STATE_URL)
+            logger.info(f"✅ Shared state backend: {type(_store).__name__}")
+        except Exception as e:
+            logger.warning(f"⚠️ Shared state backend unavailable ({e}) - using in-process memory")
+            _store = MemoryStore()
+    return _store
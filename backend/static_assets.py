@@ -0,0 +1,137 @@
+"""
+In-memory cache for the built-in test pages (`/`, `/test_opair_chat.html`).
+
+Each asset is read once at startup and kept as raw, gzip and (when brotli is
+installed) brotli bodies, with an ETag and Last-Modified. File-backed assets
+are re-read when their mtime/size changes, checked at most every
+STATIC_CHECK_INTERVAL seconds. Requests with a matching If-None-Match (or an
+If-Modified-Since no older than the file) get a 304 without a body.
+"""
+import email.utils
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from starlette.responses import Response
+
+from codec import BROTLI_AVAILABLE, choose_encoding, compress
+
+logger = logging.getLogger(__name__)
+
+STATIC_CHECK_INTERVAL = float(os.getenv("STATIC_CHECK_INTERVAL", "1"))
+STATIC_CACHE_CONTROL = os.getenv("STATIC_CACHE_CONTROL", "no-cache")  # always revalidate -> cheap 304s
+
+
+class StaticAsset:
+    __slots__ = ("media_type", "path", "bodies", "etag", "last_modified", "modified_at", "stat", "checked_at")
+
+    def __init__(self, media_type: str, path: Optional[str] = None):
+        self.media_type = media_type
+        self.path = path
+        self.bodies: Dict[Optional[str], bytes] = {}
+        self.etag = ""
+        self.last_modified = ""
+        self.modified_at = 0.0
+        self.stat = None
+        self.checked_at = 0.0
+
+    def set_body(self, body: bytes, modified_at: float):
+        self.bodies = {None: body, "gzip": compress(body, "gzip")}
+        if BROTLI_AVAILABLE:
+            self.bodies["br"] = compress(body, "br")
+        self.etag = hashlib.sha256(body).hexdigest()[:16]
+        self.modified_at = int(modified_at)
+        self.last_modified = email.utils.formatdate(self.modified_at, usegmt=True)
+
+
+class StaticAssetCache:
+    def __init__(self):
+        self._assets: Dict[str, StaticAsset] = {}
+        self._lock = threading.Lock()
+
+    def add_inline(self, name: str, content: str, media_type: str = "text/html; charset=utf-8"):
+        asset = StaticAsset(media_type)
+        asset.set_body(content.encode("utf-8"), time.time())
+        self._assets[name] = asset
+
+    def add_file(self, name: str, path: str, media_type: str = "text/html; charset=utf-8"):
+        self._assets[name] = StaticAsset(media_type, path)
+
+    def _reload(self, name: str, asset: StaticAsset, now: float):
+        asset.checked_at = now
+        try:
+            st = os.stat(asset.path)
+        except FileNotFoundError:
+            if asset.bodies:
+                logger.warning(f"⚠️ Static asset {asset.path} disappeared")
+            asset.bodies, asset.stat = {}, None
+            return
+        stat = (st.st_mtime_ns, st.st_size)
+        if stat == asset.stat:
+            return
+        with open(asset.path, "rb") as f:
+            asset.set_body(f.read(), st.st_mtime)
+        asset.stat = stat
+        logger.info(f"📄 Static asset {name} loaded ({len(asset.bodies[None])} bytes, etag {asset.etag})")
+
+    def load(self):
+        """Read all file-backed assets (called at startup)."""
+        now = time.monotonic()
+        with self._lock:
+            for name, asset in self._assets.items():
+                if asset.path is not None:
+                    self._reload(name, asset, now)
+
+    def get(self, name: str) -> Optional[StaticAsset]:
+        asset = self._assets.get(name)
+        if asset is None:
+            return None
+        if asset.path is not None:
+            now = time.monotonic()
+            if now - asset.checked_at >= STATIC_CHECK_INTERVAL:
+                with self._lock:
+                    if now - asset.checked_at >= STATIC_CHECK_INTERVAL:
+                        self._reload(name, asset, now)
+        return asset if asset.bodies else None
+
+    def response(self, name: str, headers) -> Optional[Response]:
+        """Cached response for `name` given the request headers; None when the asset is missing."""
+        asset = self.get(name)
+        if asset is None:
+            return None
+        encoding = choose_encoding(headers.get("accept-encoding", ""))
+        if encoding not in asset.bodies:
+            encoding = None
+        # One strong ETag per representation; If-None-Match matches any of them
+        etag = f'"{asset.etag}-{encoding}"' if encoding else f'"{asset.etag}"'
+        response_headers = {
+            "ETag": etag,
+            "Last-Modified": asset.last_modified,
+            "Cache-Control": STATIC_CACHE_CONTROL,
+            "Vary": "Accept-Encoding",
+        }
+        if self._not_modified(asset, headers):
+            return Response(status_code=304, headers=response_headers)
+        if encoding:
+            response_headers["Content-Encoding"] = encoding
+        return Response(content=asset.bodies[encoding], media_type=asset.media_type, headers=response_headers)
+
+    @staticmethod
+    def _not_modified(asset: StaticAsset, headers) -> bool:
+        if_none_match = headers.get("if-none-match")
+        if if_none_match is not None:
+            if if_none_match.strip() == "*":
+                return True
+            tags = {tag.strip().removeprefix("W/").strip('"') for tag in if_none_match.split(",")}
+            return any(tag.split("-", 1)[0] == asset.etag for tag in tags)
+        if_modified_since = headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return asset.modified_at <= since
+        return False
@@ -0,0 +1,52 @@
+from compact_store import CompactConversation, CompactConversationStore
+
+MESSAGES = [
+    {"role": "user", "content": "Hi, I'm Zoë - let's build my résumé 🚀"},
+    {"role": "assistant", "content": "Great! What's your email?"},
+    {"role": "user", "content": ""},
+    {"role": "system", "content": "x" * 10_000},
+    {"role": "tool", "content": "custom role"},
+]
+
+
+def test_round_trip():
+    conversation = CompactConversation(MESSAGES)
+    assert len(conversation) == len(MESSAGES)
+    assert conversation.messages() == MESSAGES
+
+
+def test_compress_expand_round_trip():
+    conversation = CompactConversation(MESSAGES)
+    raw_bytes = conversation.nbytes()
+    conversation.compress()
+    assert conversation.compressed
+    assert conversation.nbytes() < raw_bytes
+    assert conversation.messages() == MESSAGES
+    assert not conversation.compressed
+
+
+def test_append_after_compress():
+    conversation = CompactConversation(MESSAGES[:2])
+    conversation.compress()
+    conversation.append("user", "one more")
+    assert conversation.messages() == MESSAGES[:2] + [{"role": "user", "content": "one more"}]
+
+
+def test_empty_conversation_does_not_compress():
+    conversation = CompactConversation()
+    conversation.compress()
+    assert not conversation.compressed
+    assert conversation.messages() == []
+
+
+def test_store_compresses_idle_conversations():
+    store = CompactConversationStore(idle_seconds=0, sweep_interval=3600)
+    store.set("a", MESSAGES)
+    store.append("b", "user", "hello")
+    assert store.compress_idle() == 2
+    assert store.stats()["compressed"] == 2
+    assert store.history("a") == MESSAGES
+    assert store.history("b") == [{"role": "user", "content": "hello"}]
+    assert store.history("missing") == []
+    store.drop("a")
+    assert len(store) == 1
@@ -0,0 +1,15 @@
+import pytest
+from pydantic import ValidationError
+
+from models import ChatNormalRequest
+
+
+@pytest.mark.parametrize("max_tokens", ["256", 0, -1, 1.5, True])
+def test_chatnormal_rejects_non_positive_or_non_int_max_tokens(max_tokens):
+    with pytest.raises(ValidationError):
+        ChatNormalRequest.model_validate({"userMessage": "hi", "maxTokens": max_tokens})
+
+
+def test_chatnormal_accepts_positive_max_tokens():
+    assert ChatNormalRequest.model_validate({"maxTokens": 256}).maxTokens == 256
+    assert ChatNormalRequest.model_validate({}).maxTokens is None
@@ -0,0 +1,117 @@
+import copy
+import json
+
+import pytest
+
+from resume_delta import apply_merge_patch, make_json_patch, make_merge_patch, patch_fields
+
+
+def _parent(doc, pointer):
+    tokens = [t.replace("~1", "/").replace("~0", "~") for t in pointer.split("/")[1:]]
+    for token in tokens[:-1]:
+        doc = doc[int(token)] if isinstance(doc, list) else doc[token]
+    return doc, tokens[-1]
+
+
+def apply_json_patch(doc, ops):
+    """Minimal RFC 6902 add/remove/replace, enough to check make_json_patch output."""
+    doc = copy.deepcopy(doc)
+    for op in ops:
+        if op["path"] == "":
+            assert op["op"] == "replace"
+            doc = copy.deepcopy(op["value"])
+            continue
+        parent, token = _parent(doc, op["path"])
+        if isinstance(parent, list):
+            if op["op"] == "add":
+                if token == "-":
+                    parent.append(copy.deepcopy(op["value"]))
+                else:
+                    parent.insert(int(token), copy.deepcopy(op["value"]))
+            elif op["op"] == "remove":
+                del parent[int(token)]
+            else:
+                parent[int(token)] = copy.deepcopy(op["value"])
+        else:
+            if op["op"] == "remove":
+                del parent[token]
+            else:
+                assert op["op"] == "add" or token in parent
+                parent[token] = copy.deepcopy(op["value"])
+    return doc
+
+
+def same_json(a, b):
+    # json.dumps tells 1, 1.0 and true apart, unlike ==
+    return json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True)
+
+
+CASES = [
+    ("unchanged", {"name": "Ada", "skills": ["Go"]}, {"name": "Ada", "skills": ["Go"]}),
+    ("field added", {"name": "Ada"}, {"name": "Ada", "email": "ada@example.com"}),
+    ("field removed", {"name": "Ada", "email": "ada@example.com"}, {"name": "Ada"}),
+    ("list grows", {"skills": ["Go"]}, {"skills": ["Go", "Rust", "SQL"]}),
+    ("list shrinks", {"skills": ["Go", "Rust", "SQL"]}, {"skills": ["Go"]}),
+    ("list emptied", {"skills": ["Go", "Rust"]}, {"skills": []}),
+    ("list item edited", {"jobs": [{"title": "Dev"}, {"title": "Ops"}]}, {"jobs": [{"title": "Dev"}, {"title": "SRE"}]}),
+    ("nested dict", {"contact": {"email": "a@x.io", "phone": "1"}}, {"contact": {"email": "b@x.io"}}),
+    ("escaped keys", {"a/b": 1, "c~d": {"e/~f": 2}}, {"a/b": 3, "c~d": {"e/~f": 4, "~/": 5}}),
+    ("int to str", {"years": 3}, {"years": "3"}),
+    ("int to float", {"gpa": 4}, {"gpa": 4.0}),
+    ("int to bool", {"remote": 1}, {"remote": True}),
+    ("bool inside list", {"flags": [1, 0]}, {"flags": [True, False]}),
+    ("dict to list", {"skills": {"main": "Go"}}, {"skills": ["Go"]}),
+    ("list to scalar", {"skills": ["Go"]}, {"skills": "Go"}),
+    ("root type change", {"skills": ["Go"]}, ["Go"]),
+]
+
+
+@pytest.mark.parametrize("name,old,new", CASES, ids=[c[0] for c in CASES])
+def test_json_patch_applies_to_target(name, old, new):
+    ops = make_json_patch(old, new)
+    assert same_json(apply_json_patch(old, ops), new)
+    if same_json(old, new):
+        assert ops == []
+
+
+@pytest.mark.parametrize("name,old,new", CASES, ids=[c[0] for c in CASES])
+def test_merge_patch_applies_to_target(name, old, new):
+    patch = make_merge_patch(old, new)
+    assert same_json(apply_merge_patch(old, patch), new)
+
+
+def test_json_patch_escapes_pointer_tokens():
+    ops = make_json_patch({"a/b": 1, "c~d": 1}, {"a/b": 2, "c~d": 2})
+    assert {op["path"] for op in ops} == {"/a~1b", "/c~0d"}
+
+
+def test_json_patch_removes_from_the_end():
+    ops = make_json_patch({"s": [1, 2, 3, 4]}, {"s": [1]})
+    assert [op["path"] for op in ops] == ["/s/3", "/s/2", "/s/1"]
+
+
+def test_merge_patch_cannot_set_null():
+    old, new = {"name": "Ada", "phone": "123"}, {"name": "Ada", "phone": None}
+    patch = make_merge_patch(old, new)
+    # null in a merge patch means "remove", so the member disappears instead of becoming null
+    assert apply_merge_patch(old, patch) == {"name": "Ada"}
+
+
+def test_patch_fields_falls_back_to_document_when_merge_patch_would_drop_null():
+    old, new = {"name": "Ada", "phone": "123"}, {"name": "Ada", "phone": None}
+    assert patch_fields("merge-patch", old, new) == {"resumeData": new}
+    # JSON Patch can express it
+    fields = patch_fields("json-patch", old, new)
+    assert fields["resumeData"] is None
+    assert apply_json_patch(old, fields["resumePatch"]) == new
+
+
+def test_patch_fields_full_document_without_base():
+    new = {"name": "Ada"}
+    assert patch_fields("json-patch", None, new) == {"resumeData": new}
+    assert patch_fields("full", {"name": "Bob"}, new) == {"resumeData": new}
+
+
+def test_patch_fields_merge_patch():
+    fields = patch_fields("merge-patch", {"name": "Ada", "skills": ["Go"]}, {"name": "Ada", "skills": ["Go", "SQL"]})
+    assert fields == {"resumeData": None, "resumePatch": {"skills": ["Go", "SQL"]}, "patchFormat": "merge-patch"}
@@ -0,0 +1,33 @@
+from persistence import SessionIds, SQLiteConversationStore
+
+
+def test_issued_ids_are_valid_and_unique():
+    ids = SessionIds(b"k" * 32)
+    issued = {ids.new() for _ in range(100)}
+    assert len(issued) == 100
+    assert all(ids.valid(session_id) for session_id in issued)
+
+
+def test_rejects_ids_not_issued_by_this_secret():
+    ids = SessionIds(b"k" * 32)
+    session_id = ids.new()
+    nonce, signature = session_id.split(".")
+    assert not SessionIds(b"other" * 8).valid(session_id)
+    assert not ids.valid(f"{nonce}.{'0' * len(signature)}")
+    assert not ids.valid(f"{nonce}x.{signature}")
+    assert not ids.valid(nonce)
+    assert not ids.valid(f".{signature}")
+
+
+def test_rejects_client_chosen_and_non_string_ids():
+    ids = SessionIds(b"k" * 32)
+    for session_id in ("abc123", "", ".", "user-42", None, 123, ["x"]):
+        assert not ids.valid(session_id)
+
+
+def test_store_secret_is_shared_and_stable(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    first = SQLiteConversationStore(path).session_secret()
+    second = SQLiteConversationStore(path).session_secret()
+    assert first == second and len(first) == 32
+    assert SessionIds(second).valid(SessionIds(first).new())
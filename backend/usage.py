@@ -0,0 +1,179 @@
+"""
+Per-session token and cost accounting.
+
+Both clients report prompt / completion / cached token counts from the
+provider's usage metadata (or estimate_tokens() when a response has none)
+into a UsageLedger. The ledger aggregates in memory per
+(session, role, model, endpoint) and a background task flushes the deltas
+into a SQLite `usage` table every USAGE_FLUSH_INTERVAL seconds, so totals
+from all workers can be queried together (GET /api/usage).
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from persistence import PERSIST_DB_PATH
+
+logger = logging.getLogger(__name__)
+
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "10"))
+
+# USD per 1M tokens: (prompt, completion, cached prompt). Override with USAGE_PRICES='{"model": [in, out, cached]}'
+DEFAULT_PRICES = {
+    "gemini-2.5-flash": (0.30, 2.50, 0.075),
+}
+MODEL_PRICES: Dict[str, Tuple[float, float, float]] = {
+    **DEFAULT_PRICES,
+    **{k: tuple(v) for k, v in json.loads(os.getenv("USAGE_PRICES", "{}")).items()},
+}
+
+GROUP_COLUMNS = ("session_id", "role", "model", "endpoint")
+COUNTERS = ("requests", "prompt_tokens", "completion_tokens", "cached_tokens", "estimated_requests")
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 chars/token) for responses without usage metadata."""
+    return math.ceil(len(text) / 4) if text else 0
+
+
+def cost_usd(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int) -> Optional[float]:
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        # ":free" OpenRouter models cost nothing; anything else is unknown
+        return 0.0 if model.endswith(":free") else None
+    prompt_price, completion_price, cached_price = prices
+    uncached = max(prompt_tokens - cached_tokens, 0)
+    return (uncached * prompt_price + cached_tokens * cached_price + completion_tokens * completion_price) / 1_000_000
+
+
+class UsageLedger:
+    """Thread-safe in-memory aggregates, periodically flushed to SQLite."""
+
+    def __init__(self, path: str = PERSIST_DB_PATH, flush_interval: float = USAGE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._pending: Dict[Tuple[str, str, str, str], list] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                " session_id TEXT NOT NULL, role TEXT NOT NULL, model TEXT NOT NULL, endpoint TEXT NOT NULL,"
+                " requests INTEGER NOT NULL DEFAULT 0,"
+                " prompt_tokens INTEGER NOT NULL DEFAULT 0,"
+                " completion_tokens INTEGER NOT NULL DEFAULT 0,"
+                " cached_tokens INTEGER NOT NULL DEFAULT 0,"
+                " estimated_requests INTEGER NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (session_id, role, model, endpoint))"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10.0)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def record(self, *, session_id: Optional[str], role: Optional[str], model: str, endpoint: str,
+               prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0, estimated: bool = False):
+        key = (session_id or "-", role or "-", model, endpoint)
+        with self._lock:
+            row = self._pending.setdefault(key, [0, 0, 0, 0, 0])
+            row[0] += 1
+            row[1] += prompt_tokens
+            row[2] += completion_tokens
+            row[3] += cached_tokens
+            row[4] += 1 if estimated else 0
+
+    def _write(self, pending):
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO usage(session_id, role, model, endpoint, requests, prompt_tokens,"
+                " completion_tokens, cached_tokens, estimated_requests) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(session_id, role, model, endpoint) DO UPDATE SET"
+                " requests = requests + excluded.requests,"
+                " prompt_tokens = prompt_tokens + excluded.prompt_tokens,"
+                " completion_tokens = completion_tokens + excluded.completion_tokens,"
+                " cached_tokens = cached_tokens + excluded.cached_tokens,"
+                " estimated_requests = estimated_requests + excluded.estimated_requests",
+                [(*key, *row) for key, row in pending.items()],
+            )
+
+    async def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            await asyncio.to_thread(self._write, pending)
+        except Exception as e:
+            logger.error(f"❌ Usage flush failed ({len(pending)} rows): {e}")
+            # Put the deltas back so the next flush retries them
+            with self._lock:
+                for key, row in pending.items():
+                    current = self._pending.setdefault(key, [0, 0, 0, 0, 0])
+                    for i, value in enumerate(row):
+                        current[i] += value
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def _query(self, group_by, session_id):
+        columns = ", ".join(group_by)
+        where, params = "", ()
+        if session_id:
+            where, params = "WHERE session_id = ?", (session_id,)
+        sums = ", ".join(f"SUM({c})" for c in COUNTERS)
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT {columns}, {sums} FROM usage {where} GROUP BY {columns}"
+                " ORDER BY SUM(prompt_tokens) + SUM(completion_tokens) DESC",
+                params,
+            ).fetchall()
+            # Cost needs the model, so price per (group, model) and add up
+            cost_rows = conn.execute(
+                f"SELECT {columns}, model, SUM(prompt_tokens), SUM(completion_tokens), SUM(cached_tokens)"
+                f" FROM usage {where} GROUP BY {columns}, model",
+                params,
+            ).fetchall()
+        costs: Dict[tuple, Optional[float]] = {}
+        n = len(group_by)
+        for row in cost_rows:
+            key = tuple(row[:n])
+            cost = cost_usd(row[n], row[n + 1], row[n + 2], row[n + 3])
+            if cost is None or (key in costs and costs[key] is None):
+                costs[key] = None
+            else:
+                costs[key] = costs.get(key, 0.0) + cost
+        result = []
+        for row in rows:
+            key = tuple(row[:n])
+            entry: Dict[str, Any] = dict(zip(group_by, key))
+            entry.update(zip(COUNTERS, row[n:]))
+            entry["cost_usd"] = costs.get(key)
+            result.append(entry)
+        return result
+
+    async def summary(self, group_by=("model", "endpoint"), session_id: Optional[str] = None):
+        """Aggregated usage from all workers' flushed ledgers (flushes this worker first)."""
+        group_by = [c for c in group_by if c in GROUP_COLUMNS] or ["model", "endpoint"]
+        await self.flush()
+        return await asyncio.to_thread(self._query, group_by, session_id)
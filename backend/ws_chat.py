@@ -0,0 +1,324 @@
+"""
+WebSocket chat support for /ws/chat.
+
+One socket = one conversation. History, extracted facts and the latest
+resumeData live in connection-local memory, so each frame only carries the
+new user message instead of the full history. History is held packed in a
+compact_store.CompactConversationStore and compressed while the socket idles.
+Connecting with ?session=<id> restores a persisted session and persists
+every new turn.
+With ?responseMode=json-patch|merge-patch, "done" frames carry a patch
+against the last resumeData sent on the socket instead of the full document.
+
+Protocol (JSON text frames):
+    client -> server
+        {"type": "message", "content": "...", "role": "general"}
+        {"type": "pong"}
+        (a plain, non-JSON text frame is treated as a message)
+    server -> client
+        {"type": "ready", "maxPending": N, "sessionId": ..., "conversationHistory": [...], "resumeData": {...},
+         "resumeVersion": N}
+        {"type": "delta", "content": "..."}
+        {"type": "done", "assistantMessage": "...", "resumeData": {...}}
+            (patch modes: "resumeData": null, "resumePatch": ..., "patchFormat": "...";
+             ?session= sockets also get "resumeVersion", numbered like /api/chat's)
+        {"type": "error", "message": "..."}
+        {"type": "ping"}
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from fastapi import WebSocket, WebSocketDisconnect
+from fact_extractor import pre_extract_facts, build_facts_context
+from resume_delta import patch_fields
+from compact_store import CompactConversationStore
+from log_config import log_exception
+
+logger = logging.getLogger(__name__)
+
+WS_MAX_CONNECTIONS = int(os.getenv("WS_MAX_CONNECTIONS", "200"))
+WS_MAX_PENDING = int(os.getenv("WS_MAX_PENDING", "4"))
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "32"))
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "20"))
+WS_PING_TIMEOUT = float(os.getenv("WS_PING_TIMEOUT", "60"))
+WS_MAX_MESSAGE_CHARS = int(os.getenv("WS_MAX_MESSAGE_CHARS", "8000"))
+
+# Close codes (RFC 6455 / IANA registry)
+CLOSE_TRY_AGAIN_LATER = 1013
+CLOSE_POLICY_VIOLATION = 1008
+CLOSE_GOING_AWAY = 1001
+
+_DONE = object()
+
+
+class ConnectionLimiter:
+    """Caps concurrent sockets per worker process (single event loop, so no lock needed)."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+
+    def try_acquire(self) -> bool:
+        if self.active >= self.limit:
+            return False
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active = max(0, self.active - 1)
+
+
+connection_limiter = ConnectionLimiter(WS_MAX_CONNECTIONS)
+
+# History of open sockets, packed compactly and compressed while a socket sits idle
+held_conversations = CompactConversationStore()
+
+
+class ChatSession:
+    """Connection-local conversation state."""
+
+    def __init__(self, role: str = "general", session_id: Optional[str] = None):
+        self.role = role
+        self.session_id = session_id
+        self.key = uuid.uuid4().hex
+        self.facts: Dict[str, str] = {}
+        self.resume_data: Optional[Dict[str, Any]] = None
+        self.resume_version = 0
+        self.last_seen = time.monotonic()
+        self.busy = False
+
+    @property
+    def history(self) -> List[Dict[str, str]]:
+        """A fresh list of message dicts, unpacked from the compact store."""
+        return held_conversations.history(self.key)
+
+    def restore(self, stored: Dict[str, Any]):
+        """Load a persisted session (see persistence.load_session)."""
+        history = stored["conversationHistory"]
+        held_conversations.set(self.key, history)
+        self.resume_data = stored["resumeData"]
+        self.resume_version = stored["resumeVersion"]
+        self.facts = pre_extract_facts(history)
+
+    def add_user_message(self, content: str):
+        # Facts only need the new message; older facts are already held
+        self.facts.update(pre_extract_facts([{"role": "user", "content": content}]))
+
+    def facts_context(self) -> str:
+        return build_facts_context(self.facts)
+
+    def record_turn(self, user_message: str, assistant_message: str, resume_data):
+        held_conversations.append(self.key, "user", user_message)
+        held_conversations.append(self.key, "assistant", assistant_message)
+        if resume_data is not None:
+            self.resume_data = resume_data
+
+    def close(self):
+        held_conversations.drop(self.key)
+
+
+class _SocketSender:
+    """Serializes sends from the reply streamer and the keepalive task."""
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.lock = asyncio.Lock()
+
+    async def send(self, payload: Dict[str, Any]):
+        async with self.lock:
+            await self.websocket.send_text(json.dumps(payload))
+
+
+def _parse_frame(text: str) -> Dict[str, Any]:
+    try:
+        frame = json.loads(text)
+    except ValueError:
+        return {"type": "message", "content": text}
+    if not isinstance(frame, dict):
+        return {"type": "message", "content": text}
+    return frame
+
+
+async def _stream_reply(sender: _SocketSender, session: ChatSession, client, user_message: str):
+    """
+    Run GeminiClient.stream_message in a worker thread and forward deltas.
+
+    The thread hands chunks over through a bounded queue, so a slow socket
+    stalls the upstream read instead of buffering the whole reply in memory.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+    stop = threading.Event()
+    history = session.history
+    facts_context = session.facts_context()
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce():
+        try:
+            for chunk in client.stream_message(
+                history, user_message, session.role, facts_context, session_id=session.session_id
+            ):
+                if stop.is_set():
+                    return
+                put(chunk)
+        except Exception as e:
+            if not stop.is_set():
+                put(e)
+        finally:
+            if not stop.is_set():
+                put(_DONE)
+
+    producer = loop.run_in_executor(None, produce)
+    chunks: List[str] = []
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            chunks.append(item)
+            await sender.send({"type": "delta", "content": item})
+    finally:
+        stop.set()
+        # Unblock a producer waiting on a full queue so the thread can exit
+        while not queue.empty():
+            queue.get_nowait()
+
+    await producer
+    assistant_message = "".join(chunks)
+    resume_data = client.parse_json_text(assistant_message) if assistant_message else None
+    return assistant_message, resume_data
+
+
+async def _keepalive(websocket: WebSocket, sender: _SocketSender, session: ChatSession):
+    try:
+        while True:
+            await asyncio.sleep(WS_PING_INTERVAL)
+            idle = time.monotonic() - session.last_seen
+            if idle > WS_PING_TIMEOUT and not session.busy:
+                logger.warning(f"⚠️ /ws/chat client missed pongs for {idle:.0f}s - closing")
+                await websocket.close(code=CLOSE_GOING_AWAY)
+                return
+            await sender.send({"type": "ping"})
+            # Idle sockets still get their history compressed
+            held_conversations.maybe_sweep()
+    except (WebSocketDisconnect, RuntimeError):
+        # Socket already closed underneath us
+        return
+
+
+async def _reader(websocket: WebSocket, sender: _SocketSender, session: ChatSession, inbound: asyncio.Queue):
+    """Read frames; a full inbound queue stops reading so TCP pushes back on the client."""
+    while True:
+        text = await websocket.receive_text()
+        session.last_seen = time.monotonic()
+        frame = _parse_frame(text)
+        kind = frame.get("type", "message")
+        if kind == "ping":
+            await sender.send({"type": "pong"})
+        elif kind == "message":
+            await inbound.put(frame)
+
+
+async def handle_chat_socket(websocket: WebSocket, client, writer=None, versions=None):
+    """
+    Serve one /ws/chat connection until the client disconnects.
+    `writer` is an optional persistence.PersistenceWriter for ?session=<id> sockets, and
+    `versions` the resume_delta.ResumeVersions numbering their resume snapshots.
+    """
+    await websocket.accept()
+    if not connection_limiter.try_acquire():
+        logger.warning(f"⚠️ /ws/chat connection cap reached ({connection_limiter.limit})")
+        await websocket.close(code=CLOSE_TRY_AGAIN_LATER)
+        return
+
+    session = ChatSession(
+        role=websocket.query_params.get("role", "general"),
+        session_id=websocket.query_params.get("session") if writer else None,
+    )
+    response_mode = websocket.query_params.get("responseMode", "full")
+    sender = _SocketSender(websocket)
+    inbound: asyncio.Queue = asyncio.Queue(maxsize=WS_MAX_PENDING)
+    reader_task = asyncio.create_task(_reader(websocket, sender, session, inbound))
+    keepalive_task = asyncio.create_task(_keepalive(websocket, sender, session))
+
+    try:
+        if session.session_id:
+            stored = await writer.load_session(session.session_id)
+            if stored:
+                session.restore(stored)
+        await sender.send({
+            "type": "ready",
+            "maxPending": WS_MAX_PENDING,
+            "sessionId": session.session_id,
+            "conversationHistory": session.history,
+            "resumeData": session.resume_data,
+            "resumeVersion": session.resume_version if session.session_id else None,
+        })
+        while True:
+            get_frame = asyncio.create_task(inbound.get())
+            done, _ = await asyncio.wait({get_frame, reader_task}, return_when=asyncio.FIRST_COMPLETED)
+            if get_frame not in done:
+                get_frame.cancel()
+                # Reader ended: disconnect or protocol error
+                reader_task.result()
+                return
+            frame = get_frame.result()
+
+            user_message = str(frame.get("content", "")).strip()
+            if not user_message:
+                await sender.send({"type": "error", "message": "Empty message"})
+                continue
+            if len(user_message) > WS_MAX_MESSAGE_CHARS:
+                await websocket.close(code=CLOSE_POLICY_VIOLATION)
+                return
+            if frame.get("role"):
+                session.role = frame["role"]
+
+            session.busy = True
+            try:
+                session.add_user_message(user_message)
+                assistant_message, resume_data = await _stream_reply(sender, session, client, user_message)
+                if session.session_id:
+                    writer.enqueue_turn(session.session_id, "user", user_message)
+                    writer.enqueue_turn(session.session_id, "assistant", assistant_message)
+                if session.session_id and versions is not None:
+                    # Same version counter as /api/chat; the base is the last document sent on this socket
+                    resume_fields = await versions.encode(
+                        resume_data, session.session_id, response_mode, base_resume=session.resume_data
+                    )
+                else:
+                    resume_fields = patch_fields(response_mode, session.resume_data, resume_data)
+                    if session.session_id and resume_data is not None:
+                        writer.enqueue_resume(session.session_id, resume_data)
+                if session.session_id:
+                    await writer.commit()
+                session.record_turn(user_message, assistant_message, resume_data)
+                await sender.send({
+                    "type": "done",
+                    "assistantMessage": assistant_message,
+                    **resume_fields,
+                })
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                log_exception(logger, f"❌ /ws/chat turn failed: {e}")
+                await sender.send({"type": "error", "message": f"Error: {str(e)}"})
+            finally:
+                session.busy = False
+    except WebSocketDisconnect:
+        pass
+    finally:
+        reader_task.cancel()
+        keepalive_task.cancel()
+        session.close()
+        connection_limiter.release()